@@ -35,7 +35,7 @@ from mongokit.cursor import Cursor
 from mongokit.operators import *
 from mongokit.schema_document import *
 from mongokit.mongo_exceptions import *
-from mongokit.document import Document, ObjectId
+from mongokit.document import Document, LazyAutoRef, ObjectId
 from mongokit.versioned_document import VersionedDocument
 from mongokit.database import Database
 from mongokit.collection import Collection
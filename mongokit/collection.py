@@ -26,10 +26,28 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from pymongo.collection import Collection as PymongoCollection
-from mongokit.mongo_exceptions import MultipleResultsFound
-from mongokit.cursor import Cursor
+from pymongo.errors import ConnectionFailure
+from mongokit.cursor import Cursor, wrap_document
+from mongokit.helpers import get_dotted_value
+from mongokit.migration import MigrationWriter
 
 from warnings import warn
+import Queue
+import random
+import sys
+import threading
+
+# number of sampled documents per partition used to split a parallel scan
+PARTITION_SAMPLE_SIZE = 20
+
+# the errors after which the scan of a range is resumed
+_RETRIED_ERRORS = (ConnectionFailure,)
+try:
+    from pymongo.errors import CursorNotFound
+    _RETRIED_ERRORS += (CursorNotFound,)
+except ImportError:
+    # pymongo < 2.7 reports the timed out cursors with OperationFailure
+    pass
 
 
 class Collection(PymongoCollection):
@@ -37,6 +55,7 @@ class Collection(PymongoCollection):
     def __init__(self, *args, **kwargs):
         self._documents = {}
         self._collections = {}
+        self._migration_writer = MigrationWriter(self)
         super(Collection, self).__init__(*args, **kwargs)
         self._registered_documents = self.database.connection._registered_documents
 
@@ -74,6 +93,14 @@ class Collection(PymongoCollection):
                         "If '%s' is a Document then you may have forgotten to "
                         "register it to the connection." % (name, name))
 
+    def flush_migrations(self):
+        """
+        send the pending updates of the documents migrated in memory (see
+        `Document.use_deferred_migrations`). They are sent at the end of each
+        cursor batch or after `MIGRATION_FLUSH_INTERVAL` seconds anyway.
+        """
+        self._migration_writer.flush()
+
     def find(self, *args, **kwargs):
         if not 'slave_okay' in kwargs and hasattr(self, 'slave_okay'):
             kwargs['slave_okay'] = self.slave_okay
@@ -97,7 +124,7 @@ class Collection(PymongoCollection):
         obj_class = kwargs.pop('wrap', None)
         doc = super(Collection, self).find_and_modify(*args, **kwargs)
         if doc and obj_class:
-            return self.collection[obj_class.__name__](doc)
+            return wrap_document(doc, obj_class, self)
         return doc
     find_and_modify.__doc__ = PymongoCollection.find_and_modify.__doc__ + """
         added by mongokit::
@@ -112,22 +139,206 @@ class Collection(PymongoCollection):
         return self.find_one({"_id": id})
 
     def one(self, *args, **kwargs):
-        bson_obj = self.find(*args, **kwargs)
-        count = bson_obj.count()
-        if count > 1:
-            raise MultipleResultsFound("%s results found" % count)
-        elif count == 1:
-            return bson_obj.next()
+        return self.find(*args, **kwargs)._one()
 
     def find_random(self):
         """
         return one random document from the collection
         """
-        import random
-        max = self.count()
-        if max:
-            num = random.randint(0, max-1)
-            return self.find().skip(num).next()
+        docs = self.sample(1)
+        if docs:
+            return docs[0]
+
+    def sample(self, size, wrap=None, random_field=None):
+        """
+        return a list of `size` documents randomly picked from the collection
+        (less if the collection is smaller).
+
+        If the server supports it (MongoDB >= 3.2), the documents are
+        sampled by the server. Otherwise, if `random_field` is given, the
+        documents which follow a random value in the `random_field` order
+        are returned: this field must hold a random float between 0 and 1
+        and be indexed (see the `random_field` attribute of Document). The
+        last resort is to skip a random number of documents, which is slow
+        on big collections.
+
+        `wrap` (optional): a class object used to wrap the documents
+        """
+        docs = []
+        if self.database.connection.get_max_wire_version() >= 4:
+            result = self.database.command('aggregate', self.name,
+                                           pipeline=[{'$sample': {'size': size}}],
+                                           cursor={'batchSize': size})
+            for doc in result['cursor']['firstBatch']:
+                doc = self.database._fix_outgoing(doc, self)
+                if wrap is not None:
+                    doc = wrap_document(doc, wrap, self)
+                docs.append(doc)
+        elif random_field:
+            value = random.random()
+            docs.extend(self.find({random_field: {'$gte': value}}, wrap=wrap).sort(random_field, 1).limit(size))
+            if len(docs) < size:
+                docs.extend(self.find({random_field: {'$lt': value}}, wrap=wrap).sort(
+                    random_field, 1).limit(size - len(docs)))
+        else:
+            count = self.count()
+            for skip in sorted(random.sample(xrange(count), min(size, count))):
+                docs.extend(self.find(wrap=wrap).skip(skip).limit(-1))
+        return docs
+
+    def parallel_find(self, spec=None, workers=4, field='_id', ordered=False, retries=3, wrap=None,
+                      **kwargs):
+        """
+        scan the documents matching `spec` with `workers` cursors run in
+        parallel threads and yield them.
+
+        The query is split into ranges of `field` which must be indexed,
+        present in all the documents and hold values of a single type.
+        Each range is scanned in the `field` order. If `ordered` is True,
+        the documents are yielded in this order, otherwise they are
+        yielded as soon as they are fetched.
+
+        If the cursor of a range fails because the server is unreachable
+        (or because the cursor has timed out, from pymongo 2.7), the scan of
+        the range is resumed after the last fetched document, at most
+        `retries` times. The other errors are raised at once.
+
+        `wrap` (optional): a class object used to wrap the documents.
+        Other arguments are passed to `find()`.
+        """
+        fields = kwargs.get('fields')
+        if fields is not None:
+            # the resuming needs the field and the _id
+            if not isinstance(fields, dict):
+                fields = dict((name, 1) for name in fields)
+            fields = dict((name, value) for name, value in fields.iteritems() if name not in (field, '_id'))
+            if not fields or any(value == 1 for value in fields.itervalues()):
+                fields.update({field: 1, '_id': 1})
+            kwargs['fields'] = fields
+        points = self._get_split_points(spec, field, workers)
+        ranges = zip([None] + points, points + [None])
+        stopped = threading.Event()
+        if ordered:
+            queues = [Queue.Queue(2) for _ in ranges]
+        else:
+            queues = [Queue.Queue(2 * len(ranges))] * len(ranges)
+        threads = []
+        for index, (lower, upper) in enumerate(ranges):
+            thread = threading.Thread(target=self._scan_range, args=(
+                spec, field, lower, upper, retries, wrap, kwargs, index, queues[index], stopped))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        try:
+            running = len(ranges)
+            index = 0
+            while running:
+                kind, value = queues[index].get()
+                if kind == 'docs':
+                    for doc in value:
+                        yield doc
+                elif kind == 'error':
+                    raise value[0], value[1], value[2]
+                else:
+                    running -= 1
+                    if ordered:
+                        index += 1
+        finally:
+            stopped.set()
+            for queue in set(queues):
+                while True:
+                    # unblock the threads waiting for a free slot
+                    try:
+                        queue.get_nowait()
+                    except Queue.Empty:
+                        break
+
+    def _get_split_points(self, spec, field, parts):
+        """
+        return the values of `field` which split the documents in `parts`
+        ranges of about the same size
+        """
+        if parts < 2:
+            return []
+        if self.database.connection.get_max_wire_version() >= 4:
+            size = parts * PARTITION_SAMPLE_SIZE
+            # the documents which don't match the query must not be sampled
+            pipeline = [{'$match': spec}] if spec else []
+            pipeline += [{'$sample': {'size': size}}, {'$project': {field: 1}}]
+            result = self.database.command('aggregate', self.name, pipeline=pipeline,
+                                           cursor={'batchSize': size})
+            values = [get_dotted_value(doc, field) for doc in result['cursor']['firstBatch']]
+            values = sorted(value for value in values if value is not None)
+            values = [values[len(values) * i // parts] for i in range(1, parts)] if values else []
+        else:
+            # $sample is not available, skip the sorted documents
+            count = self.find(spec).count()
+            values = []
+            for i in range(1, parts):
+                for doc in self.find(spec, fields={field: 1}).sort(field, 1).skip(count * i // parts).limit(-1):
+                    values.append(get_dotted_value(doc, field))
+        points = []
+        for value in values:
+            if value is not None and (not points or value > points[-1]):
+                points.append(value)
+        return points
+
+    def _scan_range(self, spec, field, lower, upper, retries, wrap, kwargs, index, queue, stopped):
+        def put(item):
+            while not stopped.is_set():
+                try:
+                    queue.put(item, timeout=1)
+                    return
+                except Queue.Full:
+                    pass
+
+        condition = {}
+        if lower is not None:
+            condition['$gte'] = lower
+        if upper is not None:
+            condition['$lt'] = upper
+        conditions = [spec] if spec else []
+        if condition:
+            conditions.append({field: condition})
+        sort = [(field, 1)]
+        if field != '_id':
+            sort.append(('_id', 1))
+
+        def get_resume_key(son):
+            # the values sent by the server: the wrapped documents hold
+            # the converted values of the custom types
+            return get_dotted_value(son, field), son['_id']
+
+        last = None
+        while not stopped.is_set():
+            query = conditions[:]
+            if last is not None:
+                # resume after the last fetched document
+                last_value, last_id = last
+                if field == '_id':
+                    query.append({'_id': {'$gt': last_id}})
+                else:
+                    query.append({'$or': [{field: {'$gt': last_value}},
+                                          {field: last_value, '_id': {'$gt': last_id}}]})
+            query = query[0] if len(query) == 1 else {'$and': query} if query else {}
+            try:
+                cursor = self.find(query, wrap=wrap, **kwargs).sort(sort)
+                for docs, last_key in cursor._batches(key=get_resume_key):
+                    put(('docs', docs))
+                    last = last_key
+                    if stopped.is_set():
+                        return
+                put(('end', index))
+                return
+            except _RETRIED_ERRORS:
+                if retries <= 0:
+                    put(('error', sys.exc_info()))
+                    return
+                retries -= 1
+            except Exception:
+                # the other errors (ie a bad query) would happen again
+                put(('error', sys.exc_info()))
+                return
 
     def find_fulltext(self, search, **kwargs):
         """
@@ -49,14 +49,61 @@ class CallableMixin(object):
 
 _ITERABLES = (list, tuple, set, frozenset)
 
+# the limit of MongoDB < 1.7.4 which doesn't send maxBsonObjectSize
+DEFAULT_MAX_BSON_SIZE = 4 * 1024 * 1024
+
 
 class MongoKitConnection(object):
 
     def __init__(self, *args, **kwargs):
         self._databases = {}
         self._registered_documents = {}
+        self._max_bson_size = None
+        self._ismaster = None
         super(MongoKitConnection, self).__init__(*args, **kwargs)
 
+    def _get_ismaster(self, refresh=False):
+        if refresh or self._ismaster is None:
+            self._ismaster = self['admin'].command('ismaster')
+        return self._ismaster
+
+    def get_max_bson_size(self, refresh=False):
+        """
+        return the maximum size (in bytes) of a document accepted by the server.
+
+        The value is taken from the connection handshake (`maxBsonObjectSize`)
+        and cached for the life of the connection. If `refresh` is True, the
+        server is asked again (ie after a failover to another primary).
+        """
+        if refresh or not self._max_bson_size:
+            max_bson_size = None
+            if not refresh:
+                # pymongo keeps the ismaster response of the handshake but
+                # not all connection classes expose it
+                max_bson_size = getattr(type(self), 'max_bson_size', None) and self.max_bson_size
+            if not isinstance(max_bson_size, (int, long)) or not max_bson_size:
+                max_bson_size = self._get_ismaster(refresh).get('maxBsonObjectSize', DEFAULT_MAX_BSON_SIZE)
+            self._max_bson_size = max_bson_size
+        return self._max_bson_size
+
+    def get_max_message_size(self, refresh=False):
+        """
+        return the maximum size (in bytes) of a message accepted by the server
+        (`maxMessageSizeBytes`). Servers older than 2.4 accept twice the
+        maximum document size.
+        """
+        ismaster = self._get_ismaster(refresh)
+        return ismaster.get('maxMessageSizeBytes', 2 * self.get_max_bson_size(refresh))
+
+    def get_max_wire_version(self, refresh=False):
+        """
+        return the highest version of the wire protocol supported by the
+        server (`maxWireVersion`, 0 for servers older than 2.6). It tells
+        which features can be used: ie, `$sample` is available from 4
+        (MongoDB 3.2).
+        """
+        return self._get_ismaster(refresh).get('maxWireVersion', 0)
+
     def register(self, obj_list):
         decorator = None
         if not isinstance(obj_list, _ITERABLES):
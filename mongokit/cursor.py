@@ -26,19 +26,424 @@
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 from pymongo.cursor import Cursor as PymongoCursor
+from bson.dbref import DBRef
 from collections import deque
+from mongokit.mongo_exceptions import MultipleResultsFound
+from mongokit.schema_document import CustomType
+from copy import deepcopy
+import Queue
+import sys
+import threading
+import weakref
+
+# documents fetched by the cursor which is wrapping the current document,
+# see Cursor.prefetch_autorefs()
+_prefetched_autorefs = threading.local()
+
+
+def get_prefetched_autoref(database, collection, _id):
+    """
+    return a copy of the referenced document if it has been prefetched by
+    the cursor which is wrapping the current document, None otherwise
+    """
+    docs = getattr(_prefetched_autorefs, 'docs', None)
+    if docs:
+        try:
+            doc = docs.get((database, collection, _id))
+        except TypeError:  # unhashable _id
+            return None
+        if doc is not None:
+            return deepcopy(doc)
+
+
+def _collect_dbrefs(value, dbrefs):
+    if isinstance(value, DBRef):
+        dbrefs.append(value)
+    elif isinstance(value, dict):
+        for item in value.itervalues():
+            _collect_dbrefs(item, dbrefs)
+    elif isinstance(value, list):
+        for item in value:
+            _collect_dbrefs(item, dbrefs)
+
+
+def wrap_document(son, wrap, collection, lazy=False, projection=None, classes=None, lookup=True):
+    """
+    wrap the raw document `son` into `wrap` or into the registered document
+    named by its type field. `projection` is the fields selected by the
+    query, if any.
+
+    `classes` maps the type names to their document class. The classes
+    looked up in the collection are added to it. If `lookup` is False,
+    only `classes` is used.
+    """
+    if wrap.type_field in son:
+        name = son[wrap.type_field]
+        if classes is not None and name in classes:
+            wrap = classes[name]
+        elif lookup:
+            wrap = getattr(collection, name)
+            wrap = getattr(type(wrap), '_obj_class', wrap)
+            if classes is not None:
+                classes[name] = wrap
+    if hasattr(wrap, 'from_bson'):
+        return wrap.from_bson(son, collection=collection, lazy=lazy, projection=projection)
+    return wrap(son, collection=collection)
+
+
+def _get_path_value(doc, bits):
+    # like MongoDB, the lists met on the path are traversed
+    for index, bit in enumerate(bits):
+        if isinstance(doc, list):
+            return [_get_path_value(item, bits[index:]) for item in doc]
+        if not isinstance(doc, dict):
+            return None
+        doc = doc.get(bit)
+    return doc
+
+
+def _has_custom_types(struct):
+    if isinstance(struct, CustomType):
+        return True
+    if type(struct) is list:
+        return any(_has_custom_types(item) for item in struct)
+    if isinstance(struct, dict):
+        return any(_has_custom_types(value) for value in struct.itervalues())
+    return False
+
+
+def _convert_value(document, struct, value):
+    # apply the custom types of `struct` to `value`, in nested lists too
+    if value is None:
+        return None
+    if isinstance(struct, CustomType):
+        return struct.to_python(value)
+    if type(struct) is list:
+        if struct and isinstance(value, list):
+            return [_convert_value(document, struct[0], item) for item in value]
+    elif isinstance(struct, dict) and isinstance(value, dict):
+        document._process_custom_type('python', value, struct)
+    return value
+
+
+def _get_path_converter(document_class, path):
+    """
+    return a function which applies the custom types of the
+    `document_class` structure to the value found at `path` (see
+    `_get_path_value()`), or None if there is nothing to convert. The
+    functions are cached on the class (unless it has i18n fields).
+    """
+    if document_class.i18n:
+        # the i18n fields are set up in the structure by the first instance
+        return _make_path_converter(document_class, path)
+    converters = document_class.__dict__.get('_path_converters')
+    if converters is None:
+        converters = document_class._path_converters = {}
+    if path not in converters:
+        converters[path] = _make_path_converter(document_class, path)
+    return converters[path]
+
+
+def _make_path_converter(document_class, path):
+    struct = document_class.structure
+    # the value holds one level of list for each list met on the path
+    depth = 0
+    for bit in path.split('.'):
+        while type(struct) is list:
+            struct = struct[0] if struct else None
+            depth += 1
+        if not isinstance(struct, dict) or isinstance(struct, CustomType):
+            return None
+        if bit in struct:
+            struct = struct[bit]
+        else:
+            # {unicode: ...}
+            struct = dict((k, v) for k, v in struct.iteritems() if type(k) is type).values()
+            if not struct:
+                return None
+            struct = struct[0]
+    if not _has_custom_types(struct):
+        return None
+    document = dict.__new__(document_class)
+
+    def convert(value, depth=depth):
+        if depth and isinstance(value, list):
+            return [convert(item, depth - 1) for item in value]
+        return _convert_value(document, struct, value)
+
+    return convert
+
+
+def _prefetch_batches(cursor_ref, batches, stopped):
+    """
+    worker of `Cursor.prefetch()`: put the batches of the cursor in the
+    `batches` queue until the end of the results. The cursor is only
+    referenced while a batch is fetched so an abandoned cursor can be
+    garbage collected.
+    """
+    batch = ()
+    while batch is not None and not stopped.is_set():
+        cursor = cursor_ref()
+        if cursor is None:
+            return
+        try:
+            batch = cursor._fetch_batch()
+        except Exception:
+            batch = sys.exc_info()
+        del cursor
+        while not stopped.is_set():
+            try:
+                batches.put(batch, timeout=1)
+                break
+            except Queue.Full:
+                if cursor_ref() is None:
+                    return
+        if batch is not None and len(batch) == 3:
+            return
+
+
+class _Prefetcher(object):
+    """
+    fetch the batches of `cursor` in a thread, at most `size` batches ahead
+    """
+    def __init__(self, cursor, size):
+        self.batches = Queue.Queue(size)
+        self.stopped = threading.Event()
+        self.done = False
+        self.thread = threading.Thread(target=_prefetch_batches,
+                                       args=(weakref.ref(cursor), self.batches, self.stopped))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def get(self):
+        """
+        return the next batch as a (documents, autorefs) tuple or None
+        """
+        while not self.done:
+            try:
+                batch = self.batches.get(timeout=1)
+            except Queue.Empty:
+                if not self.thread.is_alive() and self.batches.empty():
+                    self.done = True
+                continue
+            if batch is None:
+                self.done = True
+            elif len(batch) == 3:
+                self.done = True
+                raise batch[0], batch[1], batch[2]
+            return batch
+
+    def stop(self):
+        self.stopped.set()
+        while True:
+            # unblock the thread if the queue is full
+            try:
+                self.batches.get_nowait()
+            except Queue.Empty:
+                break
+        self.thread.join()
+        self.done = True
 
 
 class Cursor(PymongoCursor):
     def __init__(self, *args, **kwargs):
         self.__wrap = None
+        self.__autorefs = None
+        self.__lazy = False
+        self.__values = None
+        self.__prefetch = 0
+        self.__prefetcher = None
+        self.__prefetched = deque()
+        self.__prefetched_autorefs = None
+        # document classes by type name
+        self.__classes = {}
+        self.__lookup_classes = True
         if kwargs:
             self.__wrap = kwargs.pop('wrap', None)
         super(Cursor, self).__init__(*args, **kwargs)
 
+    def prefetch_autorefs(self):
+        """
+        fetch the documents referenced by the autorefs (see `use_autorefs`)
+        of each batch of results with one query per collection, instead of
+        one query per reference. References of the referenced documents are
+        prefetched too.
+        """
+        self._Cursor__check_okay_to_chain()
+        self.__autorefs = {}
+        return self
+
+    def prefetch(self, batches=1):
+        """
+        fetch the next batches of results in a background thread while the
+        current one is processed. At most `batches` batches are fetched
+        ahead, which bounds the memory used.
+        """
+        self._Cursor__check_okay_to_chain()
+        self.__prefetch = batches
+        return self
+
+    def _fetch_batch(self):
+        # called by the prefetching thread only
+        if not self._refresh():
+            return None
+        data = self._Cursor__data
+        self._Cursor__data = deque()
+        return list(data), self.__autorefs
+
+    def __next_prefetched_batch(self):
+        if self.__prefetcher is None:
+            self.__prefetcher = _Prefetcher(self, self.__prefetch)
+        batch = self.__prefetcher.get()
+        if batch is None:
+            return False
+        items, self.__prefetched_autorefs = batch
+        self.__prefetched.extend(items)
+        return True
+
+    def __stop_prefetching(self):
+        if self.__prefetcher is not None:
+            self.__prefetcher.stop()
+            self.__prefetcher = None
+        self.__prefetched.clear()
+
+    def rewind(self):
+        self.__stop_prefetching()
+        return super(Cursor, self).rewind()
+    rewind.__doc__ = PymongoCursor.rewind.__doc__
+
+    def close(self):
+        self.__stop_prefetching()
+        super(Cursor, self).close()
+    close.__doc__ = PymongoCursor.close.__doc__
+
+    def polymorphic(self, *classes):
+        """
+        restrict the classes used to wrap the documents which have a type
+        field (see `type_field`) to `classes`. The documents of other types
+        are wrapped by the queried document class (so their type field is
+        changed if they are saved).
+        """
+        self._Cursor__check_okay_to_chain()
+        self.__classes = dict((document_class.__name__, document_class) for document_class in classes)
+        self.__lookup_classes = False
+        return self
+
+    def lazy(self):
+        """
+        convert the fields of the documents only when they are accessed:
+        the custom types and the dot notation of a top level field are
+        processed on its first access. Useful when only a few fields of
+        wide documents are read.
+        """
+        self._Cursor__check_okay_to_chain()
+        self.__lazy = True
+        return self
+
+    def values(self, *paths):
+        """
+        yield tuples of the values found at the dotted `paths` instead of
+        documents. Only these fields are asked to the server (unless
+        `fields` was passed to `find()`) and only their custom types are
+        converted.
+
+        >>> for title, author in tutorial.BlogPost.find().values('title', 'author.name'):
+        ...     print title, author
+        """
+        self.__set_values(paths, False)
+        return self
+
+    def scalars(self, path):
+        """
+        like `values()` but yield the value found at `path` itself
+        """
+        self.__set_values([path], True)
+        return self
+
+    def __set_values(self, paths, scalar):
+        self._Cursor__check_okay_to_chain()
+        if self._Cursor__fields is None:
+            fields = {}
+            for path in sorted(paths):
+                # an embed field can't be asked with its parent
+                if not any(path.startswith(field + '.') for field in fields):
+                    fields[path] = 1
+            if '_id' not in fields:
+                fields['_id'] = 0
+            self._Cursor__fields = fields
+        converters = [None] * len(paths)
+        if self.__wrap is not None and getattr(self.__wrap, 'structure', None):
+            converters = [_get_path_converter(self.__wrap, path) for path in paths]
+        self.__values = ([(path.split('.'), converter) for path, converter in zip(paths, converters)],
+                         scalar)
+
+    def __get_values(self, son):
+        paths, scalar = self.__values
+        values = []
+        for bits, converter in paths:
+            value = _get_path_value(son, bits)
+            if converter is not None:
+                value = converter(value)
+            values.append(value)
+        if scalar:
+            return values[0]
+        return tuple(values)
+
+    def _one(self):
+        """
+        return the only document matched by the cursor or None if there is
+        no match. A single query is done: the uniqueness is checked by
+        asking 2 documents. If more than one document match, a
+        MultipleResultsFound exception is raised (the matching documents
+        are not counted).
+        """
+        docs = list(self.limit(-2))
+        if len(docs) > 1:
+            raise MultipleResultsFound("more than one result found")
+        elif docs:
+            return docs[0]
+
+    def _refresh(self):
+        new_batch = self.__autorefs is not None and not len(self._Cursor__data)
+        length = super(Cursor, self)._refresh()
+        if new_batch and length:
+            self.__prefetch_autorefs(self._Cursor__data)
+        return length
+
+    def __prefetch_autorefs(self, docs):
+        database = self._Cursor__collection.database
+        # the documents of the previous batch are not needed anymore
+        self.__autorefs = prefetched = {}
+        queried = set()
+        dbrefs = []
+        for doc in docs:
+            _collect_dbrefs(doc, dbrefs)
+        while dbrefs:
+            ids = {}
+            for dbref in dbrefs:
+                key = (dbref.database or database.name, dbref.collection, dbref.id)
+                try:
+                    if key in queried:
+                        continue
+                    queried.add(key)
+                except TypeError:  # unhashable _id
+                    continue
+                ids.setdefault(key[:2], []).append(dbref.id)
+            dbrefs = []
+            for (db_name, col_name), col_ids in ids.iteritems():
+                collection = database.connection[db_name][col_name]
+                for doc in collection.find({'_id': {'$in': col_ids}}):
+                    prefetched[(db_name, col_name, doc['_id'])] = doc
+                    _collect_dbrefs(doc, dbrefs)
+
     def next(self):
         if self._Cursor__empty:
             raise StopIteration
+        if self.__prefetch:
+            if self.__prefetched or self.__next_prefetched_batch():
+                item = self.__prefetched.popleft()
+                return self.__manipulate_items([item], self.__prefetched_autorefs)[0]
+            raise StopIteration
         if len(self.__data) or self._refresh():
             if isinstance(self._Cursor__data, deque):
                 item = self._Cursor__data.popleft()
@@ -59,16 +464,62 @@ class Cursor(PymongoCursor):
         else:
             return item_or_cursor
 
+    def batches(self, size=None):
+        """
+        yield the results by lists, one list per batch returned by the
+        server. If `size` is given, it is used as the batch size (see
+        `batch_size()`). The wrapping work is done once per batch.
+
+        >>> for posts in tutorial.BlogPost.find().batches(500):
+        ...     index(posts)
+        """
+        for items, last_key in self._batches(size):
+            yield items
+
+    def _batches(self, size=None, key=None):
+        # like batches() but yield (items, key(last item)): `key` gets the
+        # item as returned by the server, before it is wrapped
+        if size is not None:
+            self.batch_size(size)
+        while self.__prefetch and not self._Cursor__empty:
+            if not self.__prefetched and not self.__next_prefetched_batch():
+                return
+            items = list(self.__prefetched)
+            self.__prefetched.clear()
+            last_key = key(items[-1]) if key is not None and items else None
+            yield self.__manipulate_items(items, self.__prefetched_autorefs), last_key
+        while not self._Cursor__empty and (len(self._Cursor__data) or self._refresh()):
+            data = self._Cursor__data
+            items = list(data)
+            if isinstance(data, deque):
+                data.clear()
+            else:
+                del data[:]
+            last_key = key(items[-1]) if key is not None and items else None
+            yield self.__manipulate_items(items, self.__autorefs), last_key
+
     def __manipulate_item(self, item):
+        return self.__manipulate_items([item], self.__autorefs)[0]
+
+    def __manipulate_items(self, items, autorefs):
         if self._Cursor__manipulate:
-            db = self._Cursor__collection.database
-            son = db._fix_outgoing(item, self._Cursor__collection)
-        else:
-            son = item
+            collection = self._Cursor__collection
+            fix_outgoing = collection.database._fix_outgoing
+            items = [fix_outgoing(item, collection) for item in items]
+        if self.__values is not None:
+            return [self.__get_values(son) for son in items]
         if self.__wrap is not None:
-            if self.__wrap.type_field in son:
-                return getattr(self._Cursor__collection,
-                               son[self.__wrap.type_field])(son)
-            return self.__wrap(son, collection=self._Cursor__collection)
-        else:
-            return son
+            previous_autorefs = getattr(_prefetched_autorefs, 'docs', None)
+            if autorefs:
+                _prefetched_autorefs.docs = autorefs
+            try:
+                items = [wrap_document(son, self.__wrap, self._Cursor__collection, self.__lazy,
+                                       self._Cursor__fields, self.__classes, self.__lookup_classes)
+                         for son in items]
+            finally:
+                _prefetched_autorefs.docs = previous_autorefs
+            if not len(self._Cursor__data) and not self.__prefetched:
+                # the updates of the documents migrated in memory are sent
+                # once per batch
+                self._Cursor__collection.flush_migrations()
+        return items
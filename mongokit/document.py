@@ -29,9 +29,12 @@ from mongokit.mongo_exceptions import AutoReferenceError
 from mongokit.mongo_exceptions import OptionConflictError
 from mongokit.mongo_exceptions import BadIndexError
 from mongokit.mongo_exceptions import MaxDocumentSizeError
-from mongokit.mongo_exceptions import MultipleResultsFound
+from mongokit.mongo_exceptions import PartialDocumentError
 from mongokit.mongo_exceptions import ConnectionError
 from mongokit.mongo_exceptions import OperationFailure
+from mongokit.mongo_exceptions import InvalidDocument
+from mongokit.mongo_exceptions import DuplicateKeyError
+from mongokit.mongo_exceptions import BulkWriteError
 
 from mongokit.schema_document import (
     STRUCTURE_KEYWORDS,
@@ -39,12 +42,15 @@ from mongokit.schema_document import (
     SchemaTypeError,
     SchemaProperties,
     SchemaDocument,
-    StructureError)
+    StructureError,
+    i18n,
+    structure_changed)
 from mongokit.helpers import (
     totimestamp,
     fromtimestamp,
     DotedDict)
 from mongokit.grid import FS
+from mongokit.cursor import get_prefetched_autoref, wrap_document
 import pymongo
 from bson import BSON
 from bson.binary import Binary
@@ -52,7 +58,9 @@ from bson.code import Code
 from bson.dbref import DBRef
 from bson.objectid import ObjectId
 import re
+import random
 from copy import deepcopy
+from hashlib import md5
 from uuid import UUID, uuid4
 import logging
 import datetime
@@ -61,6 +69,54 @@ STRUCTURE_KEYWORDS += ['_id', '_ns', '_revision', '_version']
 
 log = logging.getLogger(__name__)
 
+# maximum number of documents sent at once by save_many() and insert_many()
+DEFAULT_BATCH_SIZE = 1000
+
+
+def _get_fingerprint(value):
+    """
+    return a digest of the content of `value`. It is kept instead of a copy
+    of an autoreferenced document to know if the document has changed.
+    """
+    parts = []
+    _add_fingerprint_parts(value, parts)
+    return md5('\0'.join(parts)).digest()
+
+
+def _add_fingerprint_parts(value, parts):
+    # the values are tagged with their type so that 1, 1.0 and True or a
+    # list and a tuple don't give the same fingerprint
+    if type(value) is LazyAutoRef:
+        parts.append('ref:%r' % ((value.dbref.collection, value.dbref.id),))
+    elif isinstance(value, dict):
+        parts.append('dict:%s' % len(value))
+        for key in sorted(value):
+            parts.append(repr(key))
+            _add_fingerprint_parts(value[key], parts)
+    elif isinstance(value, (list, tuple)):
+        parts.append('%s:%s' % (type(value).__name__, len(value)))
+        for item in value:
+            _add_fingerprint_parts(item, parts)
+    else:
+        parts.append('%s:%r' % (type(value).__name__, value))
+
+
+def _get_loaded_structure(doc, struct):
+    """
+    return the part of `struct` which is found in `doc` (a partial document)
+    """
+    loaded = {}
+    for key, value in struct.iteritems():
+        if type(key) is type or key not in doc:
+            continue
+        if isinstance(value, dict):
+            if not isinstance(doc[key], dict):
+                continue
+            if type(value) is dict:
+                value = _get_loaded_structure(doc[key], value)
+        loaded[key] = value
+    return loaded
+
 
 class DocumentProperties(SchemaProperties):
     def __new__(mcs, name, bases, attrs):
@@ -152,9 +208,24 @@ class Document(SchemaDocument):
     skip_validation = False
     use_autorefs = False
     force_autorefs_current_db = False
+    use_partial_updates = False
+    lazy_autorefs = False
+    random_field = None
     indexes = []
     gridfs = []
     migration_handler = None
+    # if True, the documents are stamped with the version of the migrations
+    # (`_version`) and only the outdated ones are checked when loaded
+    use_schema_version = False
+    # if True, the outdated documents are migrated in memory when loaded and
+    # the updates are sent later in bulk (see DocumentMigration.upgrade)
+    use_deferred_migrations = False
+
+    # if False, validate() doesn't encode the document to check its size
+    _check_size = True
+    # BSON of the document as it is in the database (see use_partial_updates)
+    _snapshot = None
+    _projection = None
 
     authorized_types = SchemaDocument.authorized_types + [
         Binary,
@@ -176,6 +247,89 @@ class Document(SchemaDocument):
             self[self.type_field] = unicode(self.__class__.__name__)
         # collection
         self.collection = collection
+        self._init_collection(collection)
+
+    @classmethod
+    def from_bson(cls, doc, collection=None, lang='en', fallback_lang='en', lazy=False, projection=None):
+        """
+        build a document from `doc`, a dict freshly decoded from the
+        database. Used by the cursors instead of the constructor: the
+        values are trusted so only the work required by the class is done
+        (custom types conversion, dot notation, autorefs...).
+
+        If `lazy` is True, the top level fields are converted only when
+        they are accessed (see `Cursor.lazy()`).
+
+        If `projection` is not None, `doc` was returned by a query which
+        selected some fields: the document is partial (see `save()`).
+        """
+        # the snapshot must be taken before the custom types are converted
+        snapshot = None
+        if cls.use_partial_updates or projection is not None:
+            snapshot = BSON.encode(doc)
+        obj = dict.__new__(cls)
+        plan = None
+        if doc and cls.structure is not None and cls.__init__.im_func is Document.__init__.im_func:
+            plan = obj._get_validation_plan()
+            if cls.i18n and not all(isinstance(plan.index.get(field), i18n) for field in cls.i18n):
+                # the structure is not ready yet, let the constructor do it
+                plan = None
+        if plan is None:
+            if projection is not None:
+                # the constructor may validate (and migrate) the document
+                obj._set_projection(projection)
+            obj.__init__(doc=doc, collection=collection, lang=lang, fallback_lang=fallback_lang)
+        else:
+            dict.update(obj, doc)
+            authorized_types = cls.authorized_types
+            if cls.use_autorefs:
+                authorized_types = authorized_types + [Document, SchemaProperties]
+            obj.__dict__.update(
+                _authorized_types=authorized_types,
+                _current_lang=lang,
+                _fallback_lang=fallback_lang,
+                validation_errors={},
+                collection=collection)
+            if projection is not None:
+                obj._set_projection(projection)
+            pending = None
+            if lazy and not cls.use_autorefs and not cls.migration_handler:
+                pending = plan.custom_type_fields
+                if cls.use_dot_notation:
+                    pending = pending.union(plan.dict_fields)
+                if any(type(key) is type for key in pending):
+                    # the values of {unicode: CustomType} can't be loaded one by one
+                    pending = None
+                else:
+                    pending = pending.intersection(doc)
+            if pending:
+                obj.__class__ = _get_lazy_class(cls)
+                obj._pending_fields = set(pending)
+            else:
+                if plan.has_custom_types:
+                    obj._process_custom_type('python', obj, obj.structure)
+                if cls.use_dot_notation:
+                    structure = obj.structure
+                    if projection is not None:
+                        # don't add the embedded documents left out by the projection
+                        structure = _get_loaded_structure(obj, structure)
+                    obj._SchemaDocument__generate_doted_dict(obj, structure)
+            if cls.type_field in obj:
+                dict.__setitem__(obj, cls.type_field, unicode(cls.__name__))
+            obj._init_collection(collection)
+        if snapshot is not None and obj._snapshot is None:
+            obj._snapshot = snapshot
+        return obj
+
+    def _set_projection(self, projection):
+        self._projection = projection
+        if projection is None:
+            self.__dict__.pop('use_schemaless', None)
+        else:
+            # the fields left out by the projection are not missing
+            self.__dict__['use_schemaless'] = True
+
+    def _init_collection(self, collection):
         if collection:
             self.db = collection.database
             self.connection = self.db.connection
@@ -191,8 +345,28 @@ class Document(SchemaDocument):
         if self.migration_handler:
             self.skip_validation = False
             self._migration = self.migration_handler(self.__class__)
-            if self.get('_id'):
-                Document.validate(self, auto_migrate=True)
+            if self.get('_id') and self._projection is None:
+                version = None
+                if self.use_schema_version:
+                    version = self._migration.get_version()
+                if version is None:
+                    Document.validate(self, auto_migrate=True)
+                elif self.get('_version') != version:
+                    # the document is not checked anymore until the next version
+                    stamp = ({'_id': self['_id'], '_version': {'$ne': version}},
+                             {'$set': {'_version': version}})
+                    if collection and self.use_deferred_migrations:
+                        writer = collection._migration_writer
+                        # the timer must not send the migration updates of the
+                        # document without its stamp
+                        with writer._flush_lock:
+                            Document.validate(self, auto_migrate=True)
+                            writer.add([stamp])
+                    else:
+                        Document.validate(self, auto_migrate=True)
+                        if collection:
+                            collection.update(*stamp)
+                    self['_version'] = version
         if self.atomic_save is True:
             raise DeprecationWarning('atomic_save is not supported anymore. Please update you code')
 
@@ -204,9 +378,21 @@ class Document(SchemaDocument):
         """
         self._migrate(safe=safe)
 
-    def _migrate(self, safe=True, process_to_bson=True):
+    def _migrate(self, safe=True, process_to_bson=True, deferred=False):
         if process_to_bson:
             self._process_custom_type('bson', self, self.structure)
+        upgraded = None
+        if deferred and self.use_deferred_migrations:
+            upgraded = self._migration.upgrade(self)
+        if upgraded is not None:
+            new_doc, updates = upgraded
+            if updates:
+                self.collection._migration_writer.add(updates)
+            self._take_snapshot(new_doc)
+            self.clear()
+            self.update(DotedDict(new_doc))
+            self._process_custom_type('python', self, self.structure)
+            return
         self._migration.migrate(self, safe=safe)
         # reload
         old_doc = self.collection.get_from_id(self['_id'])
@@ -214,17 +400,17 @@ class Document(SchemaDocument):
             raise OperationFailure('Can not reload an unsaved document.'
                                    ' %s is not found in the database' % self['_id'])
         else:
+            if self._projection is not None:
+                # the document is complete again
+                self._set_projection(None)
+                self._snapshot = None
+            self._take_snapshot(old_doc)
             self.update(DotedDict(old_doc))
         self._process_custom_type('python', self, self.structure)
 
     def _get_size_limit(self):
-        server_version = tuple(self.connection.server_info()['version'].split("."))
-        mongo_1_8 = tuple("1.8.0".split("."))
-
-        if server_version < mongo_1_8:
-            return (3999999, '4MB')
-        else:
-            return (15999999, '16MB')
+        size_limit = self.connection.get_max_bson_size()
+        return (size_limit, '%sMB' % (size_limit / (1024 * 1024)))
 
     def validate(self, auto_migrate=False):
         if self.use_autorefs:
@@ -233,13 +419,16 @@ class Document(SchemaDocument):
                 # mean validate was called from __init__ and no collection is
                 # found when validating at __init__ with autorefs
                 self._make_reference(self, self.structure)
-        size = self.get_size()
-        (size_limit, size_limit_str) = self._get_size_limit()
-
-        if size > size_limit:
-            raise MaxDocumentSizeError("The document size is too big, documents "
-                                       "lower than %s is allowed (got %s bytes)" % (size_limit_str, size))
-        if auto_migrate:
+        if self._check_size:
+            self._check_size_limit()
+        if self._projection is not None:
+            # partial documents are schemaless and the fields left out by
+            # the projection are not required
+            plan = self._get_validation_plan()
+            if self.validators:
+                self._process_validators(self, plan)
+            self._validate_doc(self, plan.root)
+        elif auto_migrate:
             error = None
             try:
                 super(Document, self).validate()
@@ -253,12 +442,18 @@ class Document(SchemaDocument):
                 if not self.migration_handler:
                     raise StructureError(str(error))
                 else:
-                    # if we are here that's becose super.validate failed
-                    # but it has processed custom type to bson.
-                    self._migrate(process_to_bson=False)
+                    self._migrate(deferred=True)
         else:
             super(Document, self).validate()
 
+    def _check_size_limit(self):
+        size = self.get_size()
+        (size_limit, size_limit_str) = self._get_size_limit()
+
+        if size > size_limit:
+            raise MaxDocumentSizeError("The document size is too big, documents "
+                                       "lower than %s is allowed (got %s bytes)" % (size_limit_str, size))
+
     def get_size(self):
         """
         return the size of the underlying bson object
@@ -292,6 +487,17 @@ class Document(SchemaDocument):
         """
         return self.collection.find(wrap=self._obj_class, *args, **kwargs)
 
+    def parallel_find(self, spec=None, **kwargs):
+        """
+        scan the documents matching `spec` with several cursors run in
+        parallel and yield MyDoc object instances. See
+        `Collection.parallel_find()` for the arguments.
+
+        >>> for mydoc in con.MyDoc.parallel_find({'foo': 'bar'}, workers=8):
+        ...     process(mydoc)
+        """
+        return self.collection.parallel_find(spec, wrap=self._obj_class, **kwargs)
+
     def find_and_modify(self, *args, **kwargs):
         """
         Update and return an object.
@@ -314,26 +520,23 @@ class Document(SchemaDocument):
 
         If no document is found, `one()` returns `None`
         """
-        bson_obj = self.find(*args, **kwargs)
-        count = bson_obj.count()
-        if count > 1:
-            raise MultipleResultsFound("%s results found" % count)
-        elif count == 1:
-            try:
-                doc = bson_obj.next()
-            except StopIteration:
-                doc = None
-            return doc
+        return self.find(*args, **kwargs)._one()
 
     def find_random(self):
         """
         return one random document from the collection
         """
-        import random
-        max = self.collection.count()
-        if max:
-            num = random.randint(0, max-1)
-            return self.find().skip(num).next()
+        docs = self.sample(1)
+        if docs:
+            return docs[0]
+
+    def sample(self, size):
+        """
+        return a list of `size` documents randomly picked from the
+        collection (less if the collection is smaller). See
+        `Collection.sample()` for details and the `random_field` attribute.
+        """
+        return self.collection.sample(size, wrap=self._obj_class, random_field=self.random_field)
 
     def find_fulltext(self, search, **kwargs):
         """
@@ -342,7 +545,7 @@ class Document(SchemaDocument):
         rv = self.collection.database.command("text", self.collection.name, search=search, **kwargs)
         if 'results' in rv:
             for res in rv['results']:
-                res['obj'] = self._obj_class(res['obj'])
+                res['obj'] = wrap_document(res['obj'], self._obj_class, self.collection)
         return rv
 
     def get_from_id(self, id):
@@ -378,12 +581,7 @@ class Document(SchemaDocument):
 
         The query is launch against the db and collection of the object.
         """
-        bson_obj = self.fetch(*args, **kwargs)
-        count = bson_obj.count()
-        if count > 1:
-            raise MultipleResultsFound("%s results found" % count)
-        elif count == 1:
-            return bson_obj.next()
+        return self.fetch(*args, **kwargs)._one()
 
     def reload(self):
         """
@@ -400,6 +598,7 @@ class Document(SchemaDocument):
             raise OperationFailure('Can not reload an unsaved document.'
                                    ' %s is not found in the database' % self['_id'])
         else:
+            self._take_snapshot(old_doc)
             self.update(DotedDict(old_doc))
         self._process_custom_type('python', self, self.structure)
 
@@ -421,19 +620,87 @@ class Document(SchemaDocument):
         saving. Not that the `validate` method will be called *before* the
         uuid is generated.
 
+        If `use_partial_updates` is True and the document was loaded from
+        the database, only the modified fields are sent (see
+        `get_changes()`).
+
+        A partial document (loaded by a query with `fields`) is always
+        saved this way. A PartialDocumentError is raised if it would have
+        to replace the whole document.
+
         `save()` follow the pymongo.collection.save arguments
         """
-        if validate is True or (validate is None and self.skip_validation is False):
-            self.validate(auto_migrate=False)
-        else:
-            if self.use_autorefs:
-                self._make_reference(self, self.structure)
+        self._prepare_write(validate)
         if '_id' not in self:
             if uuid:
                 self['_id'] = unicode("%s-%s" % (self.__class__.__name__, uuid4()))
         self._process_custom_type('bson', self, self.structure)
-        self.collection.save(self, safe=safe, *args, **kwargs)
-        self._process_custom_type('python', self, self.structure)
+        try:
+            changes = None
+            if self._snapshot is not None and not args and '_id' in self:
+                changes = self._get_changes()
+            if changes:
+                result = self.collection.update({'_id': self['_id']}, changes, safe=safe, **kwargs)
+                if result and result.get('n') == 0:
+                    # the document has been removed in the meantime
+                    changes = None
+            if changes is None:
+                if self._projection is not None:
+                    raise PartialDocumentError("%s is partial (fields %s), it can't replace "
+                                               "the whole document" % (
+                                                   self.__class__.__name__, self._projection.keys()))
+                self.collection.save(self, safe=safe, *args, **kwargs)
+            self._take_snapshot(self)
+        except InvalidDocument:
+            # raise a MaxDocumentSizeError if the document was refused
+            # because of its size
+            self._check_size_limit()
+            raise
+        finally:
+            self._process_custom_type('python', self, self.structure)
+
+    def get_changes(self):
+        """
+        return the update document (`$set`, `$unset` and `$push` operators)
+        which would be sent by `save()` to bring the document in the database
+        up to date. This works only with `use_partial_updates`: None is
+        returned if the document wasn't loaded from the database.
+        """
+        self._process_custom_type('bson', self, self.structure)
+        try:
+            return self._get_changes()
+        finally:
+            self._process_custom_type('python', self, self.structure)
+
+    def save_many(self, docs, uuid=False, validate=None, safe=True, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        save a list of documents into the collection with as few round trips
+        as possible.
+
+        `docs` may contain instances of this document or plain dicts (which
+        are wrapped into this document, their `_id` is set once saved). Each
+        document is validated like in `save()`, then the documents are sent
+        by batches of `batch_size` documents at most which don't exceed the
+        maximum message size accepted by the server. Documents which have an
+        `_id` are upserted, the other ones are inserted. Note that pymongo
+        versions without the bulk API (< 2.7) can't upsert in batches: the
+        documents are then saved one by one with `save()`.
+
+        A failing document doesn't stop the others: a dict mapping the
+        position of each failed document in `docs` to its exception is
+        returned (it is empty if all documents were saved). Note that the
+        server errors can't be reported if `safe` is False.
+        """
+        return self._bulk_write(docs, upsert=True, uuid=uuid, validate=validate,
+                                safe=safe, batch_size=batch_size)
+
+    def insert_many(self, docs, uuid=False, validate=None, safe=True, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        like `save_many()` but all documents are inserted: a document whose
+        `_id` already exists fails with a DuplicateKeyError.
+        """
+        return self._bulk_write(docs, upsert=False, uuid=uuid, validate=validate,
+                                safe=safe, batch_size=batch_size)
 
     def delete(self):
         """
@@ -632,7 +899,7 @@ class Document(SchemaDocument):
         else:
             raise TypeError("A Document is not hashable if it is not saved. Save the document before hashing it")
 
-    def __deepcopy__(self, memo={}):
+    def __deepcopy__(self, memo=None):
         obj = self.__class__(doc=deepcopy(dict(self), memo), gen_skel=False, collection=self.collection)
         obj.__dict__ = self.__dict__.copy()
         return obj
@@ -643,12 +910,18 @@ class Document(SchemaDocument):
                 raise ConnectionError('No collection found')
         return super(Document, self).__getattribute__(key)
 
-    def _make_reference(self, doc, struct, path=""):
+    def _make_reference(self, doc, struct, path="", _changed=None):
         """
         * wrap all MongoDocument with the CustomType "R()"
         * create the list of Reference in self._dbrefs
         * track the embed doc changes and save it when self.save() is called
         """
+        if _changed is None:
+            changed = {}
+            self._make_reference(doc, struct, path, changed)
+            if changed:
+                self._save_references(changed.values())
+            return
         for key in struct:
             new_key = key
             new_path = ".".join([path, new_key]).strip('.')
@@ -662,10 +935,14 @@ class Document(SchemaDocument):
                     db_name = None
                     if self.force_autorefs_current_db:
                         db_name = self.db.name
-                    struct[key] = R(struct[key], self.connection, db_name)
+                    struct[key] = R(struct[key], self.connection, db_name, lazy=self.lazy_autorefs)
+                    structure_changed()
                 # if we have DBRef into the document we have to call
                 # _process_custom_type another time.
-                if isinstance(doc[key], DBRef):
+                if isinstance(doc[key], DBRef) and struct[key].lazy:
+                    doc[key] = LazyAutoRef(DBRef(doc[key].collection, doc[key].id,
+                                                 doc[key].database or self.db.name), struct[key])
+                elif isinstance(doc[key], DBRef):
                     # XXX check this
                     if doc[key].database:
                         db = doc[key].database
@@ -676,31 +953,14 @@ class Document(SchemaDocument):
                     obj_class = struct[key]._doc
                     doc[key] = getattr(self.connection[db][col], obj_class.__name__).one({'_id': _id})
                     #doc._process_custom_type('python', doc, doc.structure)
+                if type(doc[key]) is LazyAutoRef:
+                    doc[key]._save_if_changed(validate=not self.skip_validation)
+                    continue
                 # be sure that we have an instance of MongoDocument
                 if not isinstance(doc[key], struct[key]._doc) and doc[key] is not None:
                     self._raise_exception(SchemaTypeError, new_path, "%s must be an instance of %s not %s" % (
                         new_path, struct[key]._doc.__name__, type(doc[key]).__name__))
-                # validate the embed doc
-                if not self.skip_validation and doc[key] is not None:
-                    doc[key].validate()
-                # if we didn't index the embed obj yet, well, we do it
-                if new_path not in self._dbrefs:
-                    if doc[key]:
-                        self._dbrefs[new_path] = deepcopy(dict(doc[key]))
-                    else:
-                        self._dbrefs[new_path] = None
-                else:
-                    # if the embed doc indexed was None but not the new embed one,
-                    # we update the index
-                    if self._dbrefs[new_path] is None and doc[key] is not None:
-                        doc[key].save()
-                        self._dbrefs[new_path] = doc[key]
-                    # if the embed obj is already indexed, we check is the
-                    # one we get has not changed. If so, we save the embed
-                    # obj and update the reference
-                    elif self._dbrefs[new_path] != doc[key] and doc[key] is not None:
-                        doc[key].save()
-                        self._dbrefs[new_path].update(doc[key])
+                self._track_reference(new_path, doc[key], _changed)
             elif isinstance(struct[key], dict):
                 #
                 # if the dict is still empty into the document we build
@@ -709,7 +969,7 @@ class Document(SchemaDocument):
                 if len(struct[key]) and \
                         not [i for i in struct[key].keys() if type(i) is type]:
                     if key in doc:
-                        self._make_reference(doc[key], struct[key], new_path)
+                        self._make_reference(doc[key], struct[key], new_path, _changed)
                 else:  # case {unicode:int}
                     pass
             elif isinstance(struct[key], list) and len(struct[key]):
@@ -718,9 +978,18 @@ class Document(SchemaDocument):
                         db_name = None
                         if self.force_autorefs_current_db:
                             db_name = self.db.name
-                        struct[key][0] = R(struct[key][0], self.connection, db_name)
+                        struct[key][0] = R(struct[key][0], self.connection, db_name, lazy=self.lazy_autorefs)
+                        structure_changed()
                     l_objs = []
                     for no, obj in enumerate(doc[key]):
+                        if isinstance(obj, DBRef) and struct[key][0].lazy:
+                            obj = LazyAutoRef(DBRef(obj.collection, obj.id, obj.database or self.db.name),
+                                              struct[key][0])
+                        if type(obj) is LazyAutoRef:
+                            obj._save_if_changed(validate=not self.skip_validation)
+                            l_objs.append(obj)
+                            doc[key] = l_objs
+                            continue
                         if isinstance(obj, DBRef):
                             obj = getattr(self.connection[obj.database][obj.collection],
                                           struct[key][0]._doc.__name__).get_from_id(obj.id)
@@ -728,24 +997,446 @@ class Document(SchemaDocument):
                             self._raise_exception(SchemaTypeError, new_path, "%s must be an instance of Document "
                                                                              "not %s" % (new_path, type(obj).__name__))
                         full_new_path = "%s.%s" % (new_path, no)
-                        # validate the embed doc
-                        if not self.skip_validation:
-                            obj.validate()
-                        # if we didn't index the embed obj yet, well, we do it
-                        if full_new_path not in self._dbrefs:
-                            self._dbrefs[full_new_path] = obj
-                        else:
-                            # if the embed obj is already indexed, we check is the
-                            # one we get has not changed. If so, we save the embed
-                            # obj and update the reference
-                            if self._dbrefs[full_new_path]['_id'] == obj['_id'] and self._dbrefs[full_new_path] != obj:
-                                obj.save()
-                                self._dbrefs[full_new_path].update(obj)
+                        self._track_reference(full_new_path, obj, _changed, same_id=True)
                         l_objs.append(obj)
                         doc[key] = l_objs
                 elif isinstance(struct[key][0], dict):
                     for no, obj in enumerate(doc[key]):
-                        self._make_reference(obj, struct[key][0], "%s.%s" % (new_path, no))
+                        self._make_reference(obj, struct[key][0], "%s.%s" % (new_path, no), _changed)
+
+    def _track_reference(self, path, obj, changed, same_id=False):
+        """
+        index the fingerprint of the embed obj the first time it is seen,
+        then collect it into `changed` when its fingerprint differs from
+        the indexed one. If `same_id` is True, only the modifications of
+        the indexed document are tracked (not its replacement)
+        """
+        if obj is None:
+            self._dbrefs.setdefault(path, None)
+            return
+        fingerprint = _get_fingerprint(obj)
+        indexed = self._dbrefs.get(path)
+        if indexed is not None:
+            if indexed[1] == fingerprint:
+                return
+            if same_id and indexed[0] != obj.get('_id'):
+                self._dbrefs[path] = (obj.get('_id'), fingerprint)
+                return
+        # the embed doc is new or has changed, validate it
+        if not self.skip_validation:
+            obj.validate()
+        if path in self._dbrefs:
+            changed[id(obj)] = (obj, path, fingerprint)
+        else:
+            self._dbrefs[path] = (obj.get('_id'), fingerprint)
+
+    def _save_references(self, changed):
+        # the embed docs are already validated, they are saved with one
+        # write per collection when the bulk API is available
+        validate = None if self.skip_validation else False
+        by_collection = {}
+        for obj, path, fingerprint in changed:
+            if type(obj).save.im_func is Document.save.im_func:
+                by_collection.setdefault(obj.collection.full_name, []).append(obj)
+            else:
+                # save() is overridden (ie: VersionedDocument)
+                obj.save(validate=validate)
+        for objs in by_collection.itervalues():
+            if len(objs) == 1 or not hasattr(objs[0].collection, 'initialize_unordered_bulk_op'):
+                # without the bulk API (pymongo < 2.7), the documents can't
+                # be upserted in batches
+                for obj in objs:
+                    obj.save(validate=validate)
+            else:
+                errors = objs[0].save_many(objs, validate=validate)
+                if errors:
+                    raise errors[min(errors)]
+        for obj, path, fingerprint in changed:
+            self._dbrefs[path] = (obj.get('_id'), fingerprint)
+
+    def _prepare_write(self, validate=None):
+        if self.use_deferred_migrations:
+            # the pending migrations must not overwrite the document
+            self.collection.flush_migrations()
+        if self.random_field and self.get(self.random_field) is None:
+            self[self.random_field] = random.random()
+        if self.use_schema_version and self.migration_handler and '_version' not in self \
+                and self._projection is None:
+            version = self._migration.get_version()
+            if version is not None:
+                self['_version'] = version
+        if validate is True or (validate is None and self.skip_validation is False):
+            # the size limit is checked when the document is encoded before
+            # being sent, there is no need to encode it twice
+            self._check_size = False
+            try:
+                self.validate(auto_migrate=False)
+            finally:
+                self._check_size = True
+        else:
+            if self.use_autorefs:
+                self._make_reference(self, self.structure)
+
+    def _take_snapshot(self, doc):
+        """
+        remember the state of the document in the database. `doc` must hold
+        bson values (ie: custom types not converted into python)
+        """
+        if self.use_partial_updates or self._projection is not None:
+            self._snapshot = BSON.encode(doc)
+
+    def _get_changes(self):
+        if self._snapshot is None:
+            return None
+        connection = self.connection
+        tz_aware = getattr(type(connection), 'tz_aware', None) and connection.tz_aware
+        old_doc = BSON(self._snapshot).decode(tz_aware=tz_aware, uuid_subtype=self.collection.uuid_subtype)
+        if old_doc.get('_id') != self.get('_id'):
+            return None
+        changes = {}
+        self._diff(old_doc, self, "", changes)
+        if self._projection and changes:
+            self._filter_projected_changes(changes)
+            self._check_projected_changes(changes)
+        return changes
+
+    def _filter_projected_changes(self, changes):
+        # the fields left out by the projection are not in the snapshot: the
+        # values found there come from the skeleton of the document
+        included, excluded = [], []
+        for field, value in self._projection.iteritems():
+            if field.endswith('.$'):
+                field = field[:-2]
+            if value:
+                included.append(field)
+            else:
+                excluded.append(field)
+        # a projection which only has operators (ie `$slice`) returns all the fields
+        inclusion = any(value and not isinstance(value, dict) for value in self._projection.itervalues())
+        if inclusion and '_id' not in self._projection:
+            included.append('_id')
+
+        def is_in(path, fields):
+            return any(path == field or path.startswith(field + '.') for field in fields)
+
+        def is_above(path, fields):
+            return any(field.startswith(path + '.') for field in fields)
+        for op, updated in changes.items():
+            for path in updated.keys():
+                if inclusion:
+                    outside = not is_in(path, included)
+                    partial = outside and is_above(path, included)
+                else:
+                    outside = is_in(path, excluded)
+                    partial = is_above(path, excluded)
+                if partial:
+                    raise PartialDocumentError("%s was partially loaded, it can't be updated" % path)
+                if outside:
+                    del updated[path]
+            if not updated:
+                del changes[op]
+
+    def _check_projected_changes(self, changes):
+        # the fields projected with an operator (ie `$slice` or
+        # `comments.$`) don't hold the whole value so they can't be updated
+        fields = []
+        for field, value in self._projection.iteritems():
+            if field.endswith('.$'):
+                fields.append(field[:-2])
+            elif isinstance(value, dict):
+                fields.append(field)
+        for updated in changes.itervalues():
+            for path in updated:
+                for field in fields:
+                    if path == field or path.startswith(field + '.') or field.startswith(path + '.'):
+                        raise PartialDocumentError("%s was partially loaded, it can't be updated" % field)
+
+    def _diff(self, old, new, path, changes):
+        for key in old:
+            if key not in new:
+                changes.setdefault('$unset', {})[path + key] = 1
+        for key, value in new.iteritems():
+            new_path = path + key
+            if key not in old:
+                changes.setdefault('$set', {})[new_path] = value
+                continue
+            old_value = old[key]
+            if isinstance(value, dict) and isinstance(old_value, dict):
+                if value and old_value:
+                    self._diff(old_value, value, new_path + ".", changes)
+                elif value or old_value:
+                    changes.setdefault('$set', {})[new_path] = value
+            elif isinstance(value, list) and isinstance(old_value, list):
+                if value == old_value:
+                    continue
+                length = len(old_value)
+                if length and len(value) > length and value[:length] == old_value:
+                    # items were appended
+                    changes.setdefault('$push', {})[new_path] = {'$each': value[length:]}
+                else:
+                    changes.setdefault('$set', {})[new_path] = value
+            elif value != old_value or (type(value) is not type(old_value) and
+                                        not isinstance(value, basestring)):
+                changes.setdefault('$set', {})[new_path] = value
+
+    def _bulk_write(self, docs, upsert, uuid, validate, safe, batch_size):
+        use_bulk_api = hasattr(self.collection, 'initialize_unordered_bulk_op')
+        if upsert and not use_bulk_api:
+            # without the bulk API (pymongo < 2.7), an upsert would cost a
+            # query plus an update by document: save() them one by one
+            return self._save_one_by_one(docs, uuid, validate, safe)
+        errors = {}
+        prepared = []
+        wrapped = []
+        to_insert = []
+        with_ids = []
+        seen_ids = set()
+        # pymongo < 2.7 doesn't split the batches which exceed the maximum
+        # message size: only then the documents are encoded to get their size
+        max_bson_size = None
+        if not use_bulk_api:
+            max_bson_size = self.connection.get_max_bson_size()
+        try:
+            for index, doc in enumerate(docs):
+                if not isinstance(doc, Document):
+                    raw_doc, doc = doc, self._obj_class(doc, collection=self.collection)
+                    wrapped.append((index, raw_doc, doc))
+                if doc._projection is not None:
+                    errors[index] = PartialDocumentError("%s is partial, it can't replace the whole "
+                                                         "document" % doc.__class__.__name__)
+                    continue
+                try:
+                    doc._prepare_write(validate)
+                except Exception, e:
+                    errors[index] = e
+                    continue
+                generated_id = '_id' not in doc
+                if generated_id:
+                    if uuid:
+                        doc['_id'] = unicode("%s-%s" % (doc.__class__.__name__, uuid4()))
+                    else:
+                        doc['_id'] = ObjectId()
+                doc._process_custom_type('bson', doc, doc.structure)
+                prepared.append((index, doc, generated_id))
+                size = 0
+                if max_bson_size is not None:
+                    try:
+                        size = self._get_bson_size(doc, max_bson_size)
+                    except (InvalidDocument, MaxDocumentSizeError), e:
+                        errors[index] = e
+                        continue
+                if generated_id:
+                    to_insert.append((index, doc, size))
+                else:
+                    # the server can't tell which of the documents sharing
+                    # an _id has been written
+                    if doc['_id'] in seen_ids:
+                        errors[index] = DuplicateKeyError(
+                            "_id %r is used more than once" % (doc['_id'],), 11000)
+                        continue
+                    seen_ids.add(doc['_id'])
+                    with_ids.append((index, doc, size))
+            if upsert:
+                for batch in self._split_batches(with_ids, batch_size):
+                    self._upsert_batch(batch, errors, safe)
+            else:
+                # only the documents which are not in the collection yet can
+                # be inserted
+                for batch in self._split_batches(with_ids, batch_size):
+                    existing_ids = self._get_existing_ids(batch)
+                    for index, doc, size in batch:
+                        if doc['_id'] not in existing_ids:
+                            to_insert.append((index, doc, size))
+                        else:
+                            errors[index] = DuplicateKeyError(
+                                "_id %r already exists" % (doc['_id'],), 11000)
+            for batch in self._split_batches(to_insert, batch_size):
+                self._insert_batch(batch, errors, safe)
+        finally:
+            for index, doc, generated_id in prepared:
+                if index not in errors:
+                    doc._take_snapshot(doc)
+                doc._process_custom_type('python', doc, doc.structure)
+                if generated_id and index in errors:
+                    del doc['_id']
+            for index, raw_doc, doc in wrapped:
+                if index not in errors:
+                    raw_doc['_id'] = doc['_id']
+        return errors
+
+    def _save_one_by_one(self, docs, uuid, validate, safe):
+        errors = {}
+        for index, doc in enumerate(docs):
+            raw_doc = None
+            if not isinstance(doc, Document):
+                raw_doc, doc = doc, self._obj_class(doc, collection=self.collection)
+            if doc._projection is not None:
+                errors[index] = PartialDocumentError("%s is partial, it can't replace the whole "
+                                                     "document" % doc.__class__.__name__)
+                continue
+            generated_id = '_id' not in doc
+            try:
+                doc.save(uuid=uuid, validate=validate, safe=safe)
+            except Exception, e:
+                errors[index] = e
+                if generated_id:
+                    doc.pop('_id', None)
+                continue
+            if raw_doc is not None:
+                raw_doc['_id'] = doc['_id']
+        return errors
+
+    def _get_bson_size(self, doc, max_bson_size):
+        size = len(BSON.encode(doc))
+        if size > max_bson_size:
+            raise MaxDocumentSizeError(
+                "The document size is too big, documents lower than %s bytes "
+                "is allowed (got %s bytes)" % (max_bson_size, size))
+        return size
+
+    def _remove_invalid_documents(self, batch, errors):
+        # the driver refused the batch: the documents are encoded only now
+        # to find the ones which can't be sent
+        max_bson_size = self.connection.get_max_bson_size()
+        valid = []
+        for item in batch:
+            try:
+                self._get_bson_size(item[1], max_bson_size)
+            except (InvalidDocument, MaxDocumentSizeError), e:
+                errors[item[0]] = e
+            else:
+                valid.append(item)
+        return valid
+
+    def _split_batches(self, items, batch_size):
+        # keep some room for the message header (the sizes are 0 when the
+        # driver splits the messages by itself)
+        max_message_size = self.connection.get_max_message_size() - 16 * 1024
+        batch = []
+        batch_bytes = 0
+        for item in items:
+            size = item[2]
+            if batch and (len(batch) >= batch_size or batch_bytes + size > max_message_size):
+                yield batch
+                batch = []
+                batch_bytes = 0
+            batch.append(item)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    def _get_existing_ids(self, batch):
+        ids = [doc['_id'] for index, doc, size in batch]
+        return set(i['_id'] for i in self.collection.find({'_id': {'$in': ids}}, fields=['_id']))
+
+    def _insert_batch(self, batch, errors, safe):
+        try:
+            self.collection.insert([doc for index, doc, size in batch], safe=safe, continue_on_error=True)
+        except InvalidDocument:
+            valid = self._remove_invalid_documents(batch, errors)
+            if len(valid) == len(batch):
+                raise
+            # the documents written before the refused one fail as duplicates
+            # when they are sent again, but they are found in the collection
+            if valid:
+                self._insert_batch(valid, errors, safe)
+        except OperationFailure, e:
+            # with continue_on_error, the server only reports the last error:
+            # the documents which are not in the collection are the failed ones
+            existing_ids = self._get_existing_ids(batch)
+            for index, doc, size in batch:
+                if doc['_id'] not in existing_ids:
+                    errors[index] = e
+
+    def _upsert_batch(self, batch, errors, safe):
+        bulk = self.collection.initialize_unordered_bulk_op()
+        for index, doc, size in batch:
+            bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+        try:
+            if safe:
+                bulk.execute()
+            else:
+                bulk.execute({'w': 0})
+        except InvalidDocument:
+            valid = self._remove_invalid_documents(batch, errors)
+            if len(valid) == len(batch):
+                raise
+            # the upserts already written are only replayed
+            if valid:
+                self._upsert_batch(valid, errors, safe)
+        except BulkWriteError, e:
+            for error in e.details.get('writeErrors', []):
+                errors[batch[error['index']][0]] = OperationFailure(error.get('errmsg'), error.get('code'))
+
+
+def _get_lazy_class(document_class):
+    lazy_class = document_class.__dict__.get('_lazy_class')
+    if lazy_class is None:
+        # the metaclass is skipped: the lazy class shares everything
+        # (structure, compiled plan...) with the document class
+        lazy_class = type.__new__(type(document_class), document_class.__name__,
+                                  (_LazyFields, document_class),
+                                  {'__module__': document_class.__module__,
+                                   '_document_class': document_class})
+        document_class._lazy_class = lazy_class
+    return lazy_class
+
+
+def _loading_all_fields(name):
+    def method(self, *args, **kwargs):
+        self._load_fields()
+        return getattr(self, name)(*args, **kwargs)
+    method.__name__ = name
+    return method
+
+
+class _LazyFields(object):
+    """
+    Mixin of the documents loaded by a lazy cursor (see `Cursor.lazy()`).
+    The top level fields listed in `_pending_fields` still hold their bson
+    value: they are converted (custom types, dot notation) on their first
+    access. Once all fields are loaded, or as soon as the document is
+    modified, validated or saved, the document gets back its own class.
+
+    Note that the code which reads the dict directly (ie `dict(doc)` or
+    `BSON.encode(doc)`) sees the bson values of the fields not loaded yet.
+    """
+    _pending_fields = ()
+
+    def __getitem__(self, key):
+        if key in self._pending_fields:
+            self._load_field(key)
+        return dict.__getitem__(self, key)
+
+    def get(self, key, default=None):
+        if key in self._pending_fields:
+            self._load_field(key)
+        return dict.get(self, key, default)
+
+    def _load_field(self, key):
+        struct = {key: self.structure[key]}
+        doc = {key: dict.__getitem__(self, key)}
+        self._process_custom_type('python', doc, struct)
+        if self.use_dot_notation:
+            self._SchemaDocument__generate_doted_dict(doc, struct)
+        dict.__setitem__(self, key, doc[key])
+        self._pending_fields.discard(key)
+        if not self._pending_fields:
+            self.__class__ = self._document_class
+            del self._pending_fields
+
+    def _load_fields(self):
+        for key in list(self._pending_fields):
+            self._load_field(key)
+
+# the methods which read all the values or modify the document
+for _name in ['__setitem__', '__delitem__', '__eq__', '__ne__', '__repr__',
+              '__reduce__', '__reduce_ex__', '__deepcopy__', 'items', 'values', 'iteritems',
+              'itervalues', 'viewitems', 'viewvalues', 'copy', 'pop', 'popitem',
+              'setdefault', 'update', 'clear', 'validate', 'save', 'get_changes',
+              'to_json', 'to_json_type', 'migrate', 'reload']:
+    setattr(_LazyFields, _name, _loading_all_fields(_name))
+del _name
 
 
 class R(CustomType):
@@ -753,18 +1444,23 @@ class R(CustomType):
     mongo_type = DBRef
     python_type = Document
 
-    def __init__(self, doc, connection, fallback_database=None):
+    def __init__(self, doc, connection, fallback_database=None, lazy=False):
         super(R, self).__init__()
         self._doc = doc
         self._fallback_database = fallback_database
         self.connection = connection
+        self.lazy = lazy
 
     def to_bson(self, value):
         if value is not None:
+            if type(value) is LazyAutoRef:
+                return value.dbref
             return DBRef(database=value.db.name, collection=value.collection.name, id=value['_id'])
 
     def to_python(self, value):
         if value is not None:
+            if type(value) is LazyAutoRef:
+                return value
             if not isinstance(value, DBRef):
                 if '$ref' not in value:
                     value = value.get_dbref()
@@ -779,11 +1475,118 @@ class R(CustomType):
                                    " database specified.\n If you do want to use the current database, you"
                                    " have to add the attribute `force_autorefs_current_db` as True. Please see the doc"
                                    " for more details.\n The DBRef without database is : %s " % value)
-            col = self.connection[database][value.collection]
-            doc = col.find_one({'_id': value.id})
-            if doc is None:
-                raise AutoReferenceError('Something wrong append. You probably change'
-                                         ' your object when passing it as a value to an autorefs enable document.\n'
-                                         'A document with id "%s" is not saved in the database "%s" but was giving as'
-                                         ' a reference to a %s document' % (value.id, database, self._doc.__name__))
-            return self._doc(doc, collection=col)
+            if self.lazy:
+                return LazyAutoRef(DBRef(value.collection, value.id, database), self)
+            return self._fetch(database, value.collection, value.id)
+
+    def _fetch(self, database, collection, _id):
+        col = self.connection[database][collection]
+        doc = get_prefetched_autoref(database, collection, _id)
+        if doc is None:
+            doc = col.find_one({'_id': _id})
+        if doc is None:
+            raise AutoReferenceError('Something wrong append. You probably change'
+                                     ' your object when passing it as a value to an autorefs enable document.\n'
+                                     'A document with id "%s" is not saved in the database "%s" but was giving as'
+                                     ' a reference to a %s document' % (_id, database, self._doc.__name__))
+        return self._doc(doc, collection=col)
+
+
+class LazyAutoRef(object):
+    """
+    Proxy of an autoreferenced document which is fetched on first access
+    (see `lazy_autorefs`). The reference is available as `dbref` without
+    fetching the document.
+    """
+    __slots__ = ('dbref', '_ref', '_doc', '_fingerprint')
+
+    def __init__(self, dbref, ref):
+        self.dbref = dbref
+        self._ref = ref
+        self._doc = None
+        self._fingerprint = None
+
+    @property
+    def __class__(self):
+        # so isinstance() checks against the referenced document class pass
+        return self._ref._doc
+
+    @property
+    def loaded(self):
+        return self._doc is not None
+
+    def fetch(self):
+        """
+        return the referenced document, it is fetched only once
+        """
+        if self._doc is None:
+            self._doc = self._ref._fetch(self.dbref.database, self.dbref.collection, self.dbref.id)
+            self._fingerprint = _get_fingerprint(self._doc)
+        return self._doc
+
+    def _save_if_changed(self, validate=True):
+        # a reference which has not been fetched can't have been modified
+        if self._doc is not None:
+            if validate:
+                self._doc.validate()
+            fingerprint = _get_fingerprint(self._doc)
+            if fingerprint != self._fingerprint:
+                self._doc.save()
+                self._fingerprint = fingerprint
+
+    def __getattr__(self, key):
+        if key.startswith('__'):
+            raise AttributeError(key)
+        return getattr(self.fetch(), key)
+
+    def __setattr__(self, key, value):
+        if key in LazyAutoRef.__slots__:
+            object.__setattr__(self, key, value)
+        else:
+            setattr(self.fetch(), key, value)
+
+    def __getitem__(self, key):
+        return self.fetch()[key]
+
+    def __setitem__(self, key, value):
+        self.fetch()[key] = value
+
+    def __delitem__(self, key):
+        del self.fetch()[key]
+
+    def __contains__(self, key):
+        return key in self.fetch()
+
+    def __iter__(self):
+        return iter(self.fetch())
+
+    def __len__(self):
+        return len(self.fetch())
+
+    def __nonzero__(self):
+        return True
+
+    def __eq__(self, other):
+        if type(other) is LazyAutoRef:
+            if self._doc is None and other._doc is None:
+                return self.dbref == other.dbref
+            other = other.fetch()
+        return self.fetch() == other
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.dbref.id)
+
+    def __repr__(self):
+        if self._doc is None:
+            return "<LazyAutoRef %r>" % (self.dbref,)
+        return repr(self._doc)
+
+    def __deepcopy__(self, memo=None):
+        ref = LazyAutoRef(self.dbref, self._ref)
+        if self._doc is not None:
+            ref._doc = deepcopy(self._doc, memo)
+            ref._fingerprint = self._fingerprint
+        return ref
@@ -49,6 +49,24 @@ def fromtimestamp(epoch_date):
     return datetime.datetime.utcfromtimestamp(seconds)
 
 
+def get_dotted_value(doc, path, default=None):
+    """
+    return the value found at the dotted `path` of `doc` without building
+    a DotCollapsedDict of the whole document:
+
+    >>> get_dotted_value({'a': {'b': {'c': 3}}}, 'a.b.c')
+    3
+    >>> get_dotted_value({'a': {'b': None}}, 'a.b.c', 'missing')
+    'missing'
+    """
+    value = doc
+    for bit in path.split('.'):
+        if not isinstance(value, dict) or bit not in value:
+            return default
+        value = value[bit]
+    return value
+
+
 class i18nDotedDict(dict):
     """
     Dot notation dictionary access with i18n support
@@ -28,9 +28,326 @@
 from mongokit.helpers import DotCollapsedDict
 from mongokit.mongo_exceptions import UpdateQueryError
 from mongokit.mongo_exceptions import OperationFailure
+from bson.objectid import ObjectId
+from copy import deepcopy
+import datetime
+import logging
+import re
+import sys
+import threading
+import time
+
+log = logging.getLogger(__name__)
+
+# the updates of the documents migrated in memory are sent at the end of
+# each cursor batch, when MIGRATION_BATCH_SIZE are queued or
+# MIGRATION_FLUSH_INTERVAL seconds after the first one
+MIGRATION_BATCH_SIZE = 1000
+MIGRATION_FLUSH_INTERVAL = 1
+
+
+class _Unsupported(Exception):
+    """ raised when a query or an update can't be run in memory """
+
+
+# the $type numbers which can be checked in memory
+_BSON_TYPES = {
+    1: (float,),
+    2: (basestring,),
+    3: (dict,),
+    4: (list,),
+    7: (ObjectId,),
+    8: (bool,),
+    9: (datetime.datetime,),
+    10: (type(None),),
+    16: (int,),
+    18: (long,),
+}
+
+
+# the regular expressions are only matched by the server
+_PATTERN_TYPES = (type(re.compile('')),)
+try:
+    from bson.regex import Regex
+    _PATTERN_TYPES += (Regex,)
+except ImportError:
+    # pymongo < 2.7 decodes the regular expressions with re
+    pass
+# the values which can't be compared in memory
+_UNSUPPORTED_VALUE_TYPES = (dict, list) + _PATTERN_TYPES
+
+# the update operators which can be applied in memory
+_UPDATE_OPERATORS = ['$set', '$unset', '$rename', '$inc', '$push', '$pushAll', '$addToSet', '$pull']
+
+
+def _get_values(value, bits):
+    """ return the values found at the path `bits`, following the lists """
+    if not bits:
+        return [value]
+    if isinstance(value, dict):
+        if bits[0] in value:
+            return _get_values(value[bits[0]], bits[1:])
+        return []
+    if isinstance(value, list):
+        values = []
+        if bits[0].isdigit() and int(bits[0]) < len(value):
+            values.extend(_get_values(value[int(bits[0])], bits[1:]))
+        for item in value:
+            if isinstance(item, dict):
+                values.extend(_get_values(item, bits))
+        return values
+    return []
+
+
+def _get_kind(value):
+    if isinstance(value, bool):
+        return bool
+    if isinstance(value, (int, long, float)):
+        return float
+    for kind in (basestring, datetime.datetime, ObjectId):
+        if isinstance(value, kind):
+            return kind
+    raise _Unsupported(value)
+
+
+def _equals(value, other):
+    if isinstance(other, _UNSUPPORTED_VALUE_TYPES):
+        raise _Unsupported(other)
+    if isinstance(value, bool) or isinstance(other, bool):
+        # true is not 1 for mongodb
+        return type(value) is type(other) and value == other
+    return value == other
+
+
+def _match_condition(values, condition):
+    if isinstance(condition, _PATTERN_TYPES):
+        raise _Unsupported(condition)
+    # a field matches if its value or one of its items matches
+    candidates = list(values)
+    for value in values:
+        if isinstance(value, list):
+            candidates.extend(value)
+    if not isinstance(condition, dict) or not condition or \
+            not all(key.startswith('$') for key in condition):
+        if condition is None and not values:
+            return True
+        return any(_equals(value, condition) for value in candidates)
+    for op, arg in condition.iteritems():
+        if op == '$exists':
+            matched = bool(values) == bool(arg)
+        elif op == '$eq':
+            matched = _match_condition(values, arg)
+        elif op == '$ne':
+            matched = not _match_condition(values, arg)
+        elif op in ('$gt', '$gte', '$lt', '$lte'):
+            kind = _get_kind(arg)
+            matched = False
+            for value in candidates:
+                try:
+                    if _get_kind(value) is not kind:
+                        continue
+                except _Unsupported:
+                    continue
+                if (op == '$gt' and value > arg) or (op == '$gte' and value >= arg) or \
+                        (op == '$lt' and value < arg) or (op == '$lte' and value <= arg):
+                    matched = True
+                    break
+        elif op == '$in':
+            matched = any(_match_condition(values, item) for item in arg)
+        elif op == '$nin':
+            matched = not any(_match_condition(values, item) for item in arg)
+        elif op == '$type' and arg in _BSON_TYPES:
+            matched = any(isinstance(value, _BSON_TYPES[arg]) and
+                          (arg == 8 or not isinstance(value, bool)) for value in candidates)
+        elif op == '$size':
+            matched = any(isinstance(value, list) and len(value) == arg for value in values)
+        elif op == '$not' and isinstance(arg, dict):
+            matched = not _match_condition(values, arg)
+        else:
+            raise _Unsupported(op)
+        if not matched:
+            return False
+    return True
+
+
+def _match(doc, query):
+    """ return True if `doc` matches the mongodb `query` """
+    for key, condition in query.iteritems():
+        if key == '$and':
+            matched = all(_match(doc, sub_query) for sub_query in condition)
+        elif key == '$or':
+            matched = any(_match(doc, sub_query) for sub_query in condition)
+        elif key == '$nor':
+            matched = not any(_match(doc, sub_query) for sub_query in condition)
+        elif key.startswith('$'):
+            raise _Unsupported(key)
+        else:
+            matched = _match_condition(_get_values(doc, key.split('.')), condition)
+        if not matched:
+            return False
+    return True
+
+
+def _get_parent(doc, path, create=False):
+    """ return the container of the last bit of `path` and this bit """
+    bits = path.split('.')
+    if any(bit.startswith('$') for bit in bits):
+        raise _Unsupported(path)
+    parent = doc
+    for bit in bits[:-1]:
+        if isinstance(parent, list):
+            if not bit.isdigit() or int(bit) >= len(parent):
+                raise _Unsupported(path)
+            parent = parent[int(bit)]
+        elif isinstance(parent, dict):
+            if bit not in parent:
+                if not create:
+                    return None, bits[-1]
+                parent[bit] = {}
+            parent = parent[bit]
+        else:
+            raise _Unsupported(path)
+    if isinstance(parent, list):
+        if not bits[-1].isdigit() or int(bits[-1]) >= len(parent):
+            raise _Unsupported(path)
+        return parent, int(bits[-1])
+    if not isinstance(parent, dict):
+        raise _Unsupported(path)
+    return parent, bits[-1]
+
+
+def _get_list(doc, path):
+    parent, key = _get_parent(doc, path, create=True)
+    if isinstance(parent, dict) and key not in parent:
+        parent[key] = []
+    value = parent[key]
+    if not isinstance(value, list):
+        raise _Unsupported(path)
+    return value
+
+
+def _get_items(value):
+    if isinstance(value, dict) and '$each' in value:
+        if len(value) > 1:
+            raise _Unsupported(value)
+        return value['$each']
+    return [value]
+
+
+def _apply_update(doc, update):
+    """ apply the mongodb `update` (with modifiers) to `doc` """
+    for op, fields in update.iteritems():
+        # a whole document replacement is left to the server
+        if op not in _UPDATE_OPERATORS or not isinstance(fields, dict):
+            raise _Unsupported(op)
+        for path, value in fields.iteritems():
+            try:
+                value = deepcopy(value)
+            except TypeError:
+                # ie a regular expression, which python 2 can't copy
+                raise _Unsupported(value)
+            if op == '$set':
+                parent, key = _get_parent(doc, path, create=True)
+                parent[key] = value
+            elif op == '$unset':
+                parent, key = _get_parent(doc, path)
+                if isinstance(parent, list):
+                    parent[key] = None
+                elif parent is not None:
+                    parent.pop(key, None)
+            elif op == '$rename':
+                parent, key = _get_parent(doc, path)
+                if isinstance(parent, list):
+                    raise _Unsupported(path)
+                if parent is not None and key in parent:
+                    moved = parent.pop(key)
+                    new_parent, new_key = _get_parent(doc, value, create=True)
+                    new_parent[new_key] = moved
+            elif op == '$inc':
+                parent, key = _get_parent(doc, path, create=True)
+                current = parent[key] if isinstance(parent, list) else parent.get(key, 0)
+                if _get_kind(current) is not float or _get_kind(value) is not float:
+                    raise _Unsupported(path)
+                parent[key] = current + value
+            elif op in ('$push', '$pushAll'):
+                _get_list(doc, path).extend(value if op == '$pushAll' else _get_items(value))
+            elif op == '$addToSet':
+                items = _get_list(doc, path)
+                for item in _get_items(value):
+                    if not any(_equals(existing, item) for existing in items):
+                        items.append(item)
+            elif op == '$pull':
+                if isinstance(value, (dict, list)):
+                    raise _Unsupported(value)
+                items = _get_list(doc, path)
+                items[:] = [item for item in items if not _equals(item, value)]
+
+
+class MigrationWriter(object):
+    """
+    queues the updates of the documents migrated in memory (see
+    `Document.use_deferred_migrations`) and sends them to `collection` in
+    bulk. The updates of a batch which fails to be written by the timer
+    are dropped (the error is logged).
+    """
+
+    def __init__(self, collection, interval=MIGRATION_FLUSH_INTERVAL, batch_size=MIGRATION_BATCH_SIZE):
+        self.collection = collection
+        self.interval = interval
+        self.batch_size = batch_size
+        self._updates = []
+        self._timer = None
+        self._lock = threading.Lock()
+        # the updates of a document must be sent in order (reentrant: a
+        # thread holding it may fill the queue, see Document._init_collection)
+        self._flush_lock = threading.RLock()
+
+    def add(self, updates):
+        with self._lock:
+            self._updates.extend(updates)
+            full = len(self._updates) >= self.batch_size
+            if not full and self._timer is None:
+                self._timer = threading.Timer(self.interval, self._flush_from_timer)
+                self._timer.daemon = True
+                self._timer.start()
+        if full:
+            self.flush()
+
+    def flush(self):
+        """ send the queued updates """
+        # the lock is taken even if the queue is empty: the timer may be
+        # sending the updates it has just taken from the queue
+        with self._flush_lock:
+            with self._lock:
+                updates, self._updates = self._updates, []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not updates:
+                return
+            if hasattr(self.collection, 'initialize_ordered_bulk_op'):
+                bulk = self.collection.initialize_ordered_bulk_op()
+                for spec, update in updates:
+                    bulk.find(spec).update_one(update)
+                bulk.execute()
+            else:
+                for spec, update in updates:
+                    self.collection.update(spec, update, multi=False)
+
+    def _flush_from_timer(self):
+        try:
+            self.flush()
+        except Exception:
+            # the `_version` stamp of a document is queued with its migration
+            # updates and sent after them in order: it is lost with them, and
+            # the document is migrated again when loaded
+            log.exception("failed to write the migrated documents of %s" % self.collection.full_name)
 
 
 class DocumentMigration(object):
+    # version of the documents once migrated (see Document.use_schema_version),
+    # the number of the last `migration*` method is used if None
+    version = None
 
     def __init__(self, doc_class):
         self.doc_class = doc_class
@@ -56,6 +373,49 @@ class DocumentMigration(object):
                         raise UpdateQueryError("'%s' not found in %s's structure" % (
                             field, self.doc_class.__name__))
 
+    def get_version(self):
+        """
+        return the version of the documents once migrated: the `version`
+        attribute or the number of the last `migration*` method (ie 2 for
+        `migration02__add_tags`). None if the methods are not numbered.
+        """
+        if self.version is not None:
+            return self.version
+        cls = self.__class__
+        if '_last_migration_number' not in cls.__dict__:
+            numbers = [int(match.group(1)) for match in (
+                re.match(r'migration(\d+)', name) for name in dir(cls)) if match]
+            cls._last_migration_number = max(numbers) if numbers else None
+        return cls._last_migration_number
+
+    def upgrade(self, doc):
+        """
+        apply the `migration*` methods to a copy of `doc` in memory instead
+        of updating the database. Returns the upgraded copy and the list of
+        (spec, update) to send to the database, or None if a target or an
+        update can't be run in memory.
+        """
+        try:
+            upgraded = deepcopy(dict(doc))
+        except TypeError:
+            # the document holds a value which can't be copied (ie a regular expression)
+            return None
+        updates = []
+        method_names = sorted([i for i in dir(self) if i.startswith('migration')])
+        for method_name in method_names:
+            self.clean()
+            self.doc = upgraded
+            getattr(self, method_name)()
+            if self.target and self.update:
+                try:
+                    if not _match(upgraded, self.target):
+                        continue
+                    _apply_update(upgraded, self.update)
+                except _Unsupported:
+                    return None
+                updates.append((dict(self.target, _id=doc['_id']), self.update))
+        return upgraded, updates
+
     def migrate(self, doc, safe=True):
         """migrate the doc through all migration process"""
         method_names = sorted([i for i in dir(self) if i.startswith('migration')])
@@ -75,7 +435,32 @@ class DocumentMigration(object):
                                            '%s is not found in the database' % doc['_id'])
                 # self.reload()
 
-    def migrate_all(self, collection, safe=True):
+    def migrate_all(self, collection, safe=True, batch_size=None, rate_limit=None,
+                    checkpoint=None, progress=None, workers=1):
+        """
+        apply all the `allmigration*` methods to `collection`.
+
+        By default, each migration is a single multi update. If `batch_size`
+        is set, the migration is applied by ranges of `batch_size` `_id`
+        (`workers` ranges at a time if `workers` > 1) and `rate_limit` is the
+        maximum number of documents migrated by second.
+
+        `checkpoint` is a collection (or the name of a collection of the
+        same database) which stores where each chunked migration stopped,
+        so that a failed migration resumes where it stopped and a finished
+        migration is not applied again.
+
+        `progress` is called after each update with the migration method
+        name and its stats: a dict of the `matched` and `modified` counts
+        and the `last_id` migrated.
+
+        Returns the stats by migration method name. A migration which
+        matches no document is printed as deprecated; with `safe` False,
+        the counts are not known and nothing is printed.
+        """
+        if isinstance(checkpoint, basestring):
+            checkpoint = collection.database[checkpoint]
+        results = {}
         method_names = sorted([i for i in dir(self) if i.startswith('allmigration')])
         for method_name in method_names:
             self.clean()
@@ -83,10 +468,99 @@ class DocumentMigration(object):
             getattr(self, method_name)()
             if self.target and self.update:
                 self.validate_update(self.update)
-                collection.update(self.target, self.update, multi=True, safe=safe)
-                status = collection.database.last_status()
-                if not status.get('updatedExisting', 1):
+                if batch_size:
+                    stats = self._migrate_chunks(collection, method_name, safe, batch_size,
+                                                 rate_limit, checkpoint, progress, workers)
+                else:
+                    stats = {'matched': 0, 'modified': 0, 'last_id': None}
+                    self._add_stats(stats, collection.update(self.target, self.update,
+                                                             multi=True, safe=safe))
+                    if progress is not None:
+                        progress(method_name, stats)
+                if stats is None:
+                    continue
+                results[method_name] = stats
+                if safe and not stats['matched']:
                     print "%s : %s >>> deprecated" % (self.__class__.__name__, method_name)
+        return results
+
+    def _add_stats(self, stats, result):
+        # the write results are not available with unacknowledged writes
+        if result:
+            stats['matched'] += result.get('n', 0)
+            stats['modified'] += result.get('nModified', result.get('n', 0))
+
+    def _migrate_chunks(self, collection, method_name, safe, batch_size, rate_limit,
+                        checkpoint, progress, workers):
+        checkpoint_id = '%s.%s.%s' % (collection.full_name, self.__class__.__name__, method_name)
+        stats = {'matched': 0, 'modified': 0, 'last_id': None}
+        if checkpoint is not None:
+            state = checkpoint.find_one({'_id': checkpoint_id})
+            if state is not None:
+                if state.get('done'):
+                    return None
+                for key in stats:
+                    stats[key] = state[key]
+        target, update = self.target, self.update
+        started, migrated = time.time(), 0
+        while True:
+            # read the _id of the next ranges: the target is part of the
+            # query, so every candidate document is fetched to be checked
+            ranges = []
+            last_id = stats['last_id']
+            while len(ranges) < workers:
+                query = target
+                if last_id is not None:
+                    query = {'$and': [target, {'_id': {'$gt': last_id}}]}
+                ids = [doc['_id'] for doc in collection.find(
+                    query, fields=['_id']).sort('_id', 1).limit(batch_size)]
+                if not ids:
+                    break
+                ranges.append((ids[0], ids[-1], len(ids)))
+                last_id = ids[-1]
+            if not ranges:
+                break
+            results = [None] * len(ranges)
+
+            def migrate_range(index):
+                first, last, _ = ranges[index]
+                query = {'$and': [target, {'_id': {'$gte': first, '$lte': last}}]}
+                try:
+                    results[index] = ('result', collection.update(query, update, multi=True, safe=safe))
+                except Exception:
+                    results[index] = ('error', sys.exc_info())
+            if len(ranges) == 1:
+                migrate_range(0)
+            else:
+                threads = [threading.Thread(target=migrate_range, args=(index,))
+                           for index in xrange(len(ranges))]
+                for thread in threads:
+                    thread.daemon = True
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            # the checkpoint only moves past the ranges which are all migrated
+            error = None
+            for (first, last, count), (kind, value) in zip(ranges, results):
+                if kind == 'error':
+                    error = value
+                    break
+                self._add_stats(stats, value)
+                stats['last_id'] = last
+                migrated += count
+            if checkpoint is not None:
+                checkpoint.save(dict(stats, _id=checkpoint_id, done=False), safe=True)
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if progress is not None:
+                progress(method_name, stats)
+            if rate_limit:
+                delay = started + migrated / float(rate_limit) - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+        if checkpoint is not None:
+            checkpoint.save(dict(stats, _id=checkpoint_id, done=True), safe=True)
+        return stats
 
     def get_deprecated(self, collection):
         method_names = sorted([i for i in dir(self) if i.startswith('migration') or i.startswith('allmigration')])
@@ -31,6 +31,13 @@
 from bson import InvalidDocument
 
 from pymongo.errors import OperationFailure
+from pymongo.errors import DuplicateKeyError
+try:
+    from pymongo.errors import BulkWriteError
+except ImportError:
+    # pymongo < 2.7 doesn't have the bulk API
+    class BulkWriteError(OperationFailure):
+        pass
 
 
 class AutoReferenceError(Exception):
@@ -61,6 +68,10 @@ class OptionConflictError(Exception):
     pass
 
 
+class PartialDocumentError(Exception):
+    pass
+
+
 class UpdateQueryError(Exception):
     pass
 
@@ -25,17 +25,64 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from bson import BSON
+from bson.errors import InvalidBSON
+from hashlib import md5
+from pymongo import ASCENDING, DESCENDING
+from mongokit.helpers import get_dotted_value
+import re
+import threading
+import time
 
 DEFAULT_LIMIT = 10
+DEFAULT_COUNT_TTL = 60
+
+
+class CountCache(object):
+    """ Keeps the counts of the queries in memory for `ttl` seconds
+
+    Any object with the same `get(key)` and `set(key, value)` methods (ie a
+    Django or werkzeug cache) can be given to Paginator as `count_cache`.
+    """
+
+    def __init__(self, ttl=DEFAULT_COUNT_TTL, max_size=1000):
+        self._ttl = ttl
+        self._max_size = max_size
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value, expires = self._values.get(key, (None, None))
+            if expires is not None and expires <= time.time():
+                del self._values[key]
+                return None
+            return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock:
+            if key not in self._values and len(self._values) >= self._max_size:
+                for k, (_, expires) in self._values.items():
+                    if expires <= now:
+                        del self._values[k]
+                if len(self._values) >= self._max_size:
+                    del self._values[min(self._values, key=lambda k: self._values[k][1])]
+            self._values[key] = (value, now + self._ttl)
 
 
 class Paginator(object):
     """ Provides pagination on a Cursor object
 
     Keyword arguments:
-    cursor -- Cursor of a returned query
-    page   -- The page number requested
-    limit  -- The number of items per page
+    cursor      -- Cursor of a returned query
+    page        -- The page number requested
+    limit       -- The number of items per page
+    count       -- True to count the cursor, False to not count it at all
+                   or 'estimated' to use the size of the collection when the
+                   query has no filter
+    count_cache -- cache of the exact counts (see CountCache)
 
     Properties:
     items        -- Returns the paginated Cursor object
@@ -50,25 +97,42 @@ class Paginator(object):
     page_range   -- list of page numbers
     num_pages    -- int of the number of pages
     count        -- int total number of items on the cursor
+
+    Without count, `items` is a list fetched with one more item to know if
+    there is a next page, `page_range` stops at the next page and
+    `num_pages` and `count` are None.
     """
 
-    def __init__(self, cursor, page=1, limit=DEFAULT_LIMIT):
+    def __init__(self, cursor, page=1, limit=DEFAULT_LIMIT, count=True, count_cache=None):
+        if count not in (True, False, 'estimated'):
+            raise ValueError("count must be True, False or 'estimated'")
         self._cursor = cursor
-        self._count = self._cursor.count() if cursor else 0
         self._limit = limit
         self._page = int(page)
+        self._with_count = count
+        self._count_cache = count_cache
+        self._items = None
+        self._has_more = False
+        self._count = self._get_count() if cursor else 0
         self._set_page(self._page)
 
     @property
     def items(self):
+        if self._count is None:
+            return self._fetch_items()
         return self._cursor
 
     @property
     def is_paginated(self):
+        if self._count is None:
+            return self.has_next or self.has_previous
         return self.num_pages > 1
 
     @property
     def start_index(self):
+        if self._count is None and not self.items:
+            # the page is past the end
+            return 0
         if self._page == 1:
             return 1
         if self._limit == 1:
@@ -77,6 +141,11 @@ class Paginator(object):
 
     @property
     def end_index(self):
+        if self._count is None:
+            if not self.items:
+                return 0
+            return self.start_index + len(self.items) - 1
+
         if self._limit == 1:
             return self._page
 
@@ -100,18 +169,27 @@ class Paginator(object):
 
     @property
     def has_next(self):
+        if self._count is None:
+            self._fetch_items()
+            return self._has_more
         return self.end_index < self._count
 
     @property
     def has_previous(self):
+        if self._count is None:
+            return self._page > 1
         return self.start_index - self._limit >= 0
 
     @property
     def page_range(self):
+        if self._count is None:
+            return range(1, (self.next_page if self.has_next else self._page) + 1)
         return [p for p in xrange(1, self.num_pages+1)]
 
     @property
     def num_pages(self):
+        if self._count is None:
+            return None
         if self._count <= 0:
             return 0
         if self._count <= self._limit:
@@ -128,7 +206,156 @@ class Paginator(object):
 
     def _set_page(self, _):
         if self._page > 1:
-            self._cursor.skip(self.start_index - 1)
+            self._cursor.skip((self._page - 1) * self._limit)
 
         if self._cursor:
-            self._cursor.limit(self._limit)
+            if self._count is None:
+                self._cursor.limit(self._limit + 1)
+            else:
+                self._cursor.limit(self._limit)
+
+    def _fetch_items(self):
+        if self._items is None:
+            items = list(self._cursor)
+            self._has_more = len(items) > self._limit
+            self._items = items[:self._limit]
+        return self._items
+
+    def _get_count(self):
+        if not self._with_count:
+            return None
+        spec = self._cursor._Cursor__spec
+        collection = self._cursor.collection
+        if self._with_count == 'estimated' and not spec:
+            if hasattr(collection, 'estimated_document_count'):
+                return collection.estimated_document_count()
+            return collection.database.command('collstats', collection.name)['count']
+        if self._count_cache is None:
+            return self._cursor.count()
+        key = 'mongokit-count:%s:%s' % (collection.full_name, md5(BSON.encode(spec or {})).hexdigest())
+        count = self._count_cache.get(key)
+        if count is None:
+            count = self._cursor.count()
+            self._count_cache.set(key, count)
+        return count
+
+
+# the token values which would be read as operators or patterns by the server
+_INVALID_TOKEN_TYPES = (dict, list, type(re.compile('')))
+try:
+    from bson.regex import Regex
+    _INVALID_TOKEN_TYPES += (Regex,)
+except ImportError:
+    # pymongo < 2.7 decodes the regular expressions with re
+    pass
+
+
+class KeysetPaginator(object):
+    """ Provides pagination on a Cursor object from a sort key instead of a
+    page number: a page is selected with the token of the item before it
+    (`after`) or after it (`before`), so deep pages cost the same as the
+    first one provided that the key is indexed. The cursor is never counted.
+
+    Keyword arguments:
+    cursor    -- Cursor of a returned query
+    limit     -- The number of items per page
+    after     -- token of the item preceding the requested page
+    before    -- token of the item following the requested page
+    key       -- the (dotted) field to page on, `_id` is used to break the ties
+    direction -- ASCENDING or DESCENDING
+
+    Properties:
+    items          -- list of the items of the requested page
+    has_next       -- True or False if the Cursor has a next page
+    has_previous   -- True or False if the Cursor has a previous page
+    next_token     -- token of the next page (pass it as `after`) or None
+    previous_token -- token of the previous page (pass it as `before`) or None
+    """
+
+    def __init__(self, cursor, limit=DEFAULT_LIMIT, after=None, before=None,
+                 key='_id', direction=ASCENDING):
+        if after is not None and before is not None:
+            raise ValueError("after and before cannot be used together")
+        if direction not in (ASCENDING, DESCENDING):
+            raise ValueError("direction must be ASCENDING or DESCENDING")
+        self._cursor = cursor
+        self._limit = limit
+        self._key = key
+        self._direction = direction
+        self._after = after
+        self._before = before
+        self._items = []
+        self._has_more = False
+        if cursor:
+            self._set_page()
+
+    @property
+    def items(self):
+        return self._items
+
+    @property
+    def has_next(self):
+        if self._before is not None:
+            return True
+        return self._has_more
+
+    @property
+    def has_previous(self):
+        if self._before is not None:
+            return self._has_more
+        return self._after is not None
+
+    @property
+    def next_token(self):
+        if self.has_next and self._items:
+            return self._get_token(self._items[-1])
+
+    @property
+    def previous_token(self):
+        if self.has_previous and self._items:
+            return self._get_token(self._items[0])
+
+    def _get_token(self, item):
+        value = {'i': item['_id']}
+        if self._key != '_id':
+            value['v'] = get_dotted_value(item, self._key)
+        return urlsafe_b64encode(BSON.encode(value))
+
+    def _parse_token(self, token):
+        try:
+            value = BSON(urlsafe_b64decode(str(token))).decode()
+            value, _id = value.get('v', value['i']), value['i']
+        except (TypeError, ValueError, KeyError, InvalidBSON):
+            raise ValueError("invalid pagination token: %r" % token)
+        # the tokens come from the clients: they must not inject operators
+        if isinstance(value, _INVALID_TOKEN_TYPES) or isinstance(_id, _INVALID_TOKEN_TYPES):
+            raise ValueError("invalid pagination token: %r" % token)
+        return value, _id
+
+    def _set_page(self):
+        direction = self._direction
+        token = self._after
+        if self._before is not None:
+            # walk backward from the token then put the items back in order
+            direction = -direction
+            token = self._before
+        sort = [(self._key, direction)]
+        if self._key != '_id':
+            sort.append(('_id', direction))
+        self._cursor.sort(sort).limit(self._limit + 1)
+        if token is not None:
+            op = '$gt' if direction == ASCENDING else '$lt'
+            value, _id = self._parse_token(token)
+            if self._key == '_id':
+                condition = {'_id': {op: _id}}
+            else:
+                condition = {'$or': [{self._key: {op: value}},
+                                     {self._key: value, '_id': {op: _id}}]}
+            spec = self._cursor._Cursor__spec
+            self._cursor._Cursor__spec = {'$and': [spec, condition]} if spec else condition
+        items = list(self._cursor)
+        self._has_more = len(items) > self._limit
+        items = items[:self._limit]
+        if self._before is not None:
+            items.reverse()
+        self._items = items
@@ -37,6 +37,7 @@ from mongokit.helpers import DotCollapsedDict
 from mongokit.helpers import DotExpandedDict
 from mongokit.helpers import i18nDotedDict
 from mongokit.helpers import DotedDict
+from mongokit.helpers import get_dotted_value
 
 __all__ = [
     'AuthorizedTypeError',
@@ -154,6 +155,123 @@ class DuplicateI18nError(Exception):
     pass
 
 
+# kinds of node in a compiled structure
+(NODE_ANY, NODE_TYPE, NODE_CUSTOM, NODE_OPERATOR,
+ NODE_DICT, NODE_LIST, NODE_TUPLE, NODE_IGNORED) = range(8)
+
+# bumped each time MongoKit modifies a structure in place (i18n fields or
+# autorefs wrapping). Compiled plans older than this are rebuilt.
+_structure_generation = [0]
+
+
+def structure_changed():
+    """
+    invalidate all compiled validation plans. Must be called each time a
+    structure is modified after the class creation.
+    """
+    _structure_generation[0] += 1
+
+
+class SchemaNode(object):
+    """
+    A node of a compiled structure. All the work which only depends on the
+    structure (paths, kind of check, expected types, children) is done once
+    so validating a document only costs the per-field checks.
+
+    `convert` is True if the values of a custom type node have to be
+    converted with `to_bson()` before being checked against the mongo type.
+    """
+    __slots__ = ['kind', 'path', 'struct', 'convert', 'type_name', 'dict_type',
+                 'length', 'keys', 'children', 'item', 'items']
+
+    def __init__(self, struct, path="", convert=True):
+        self.struct = struct
+        self.path = path
+        self.convert = convert
+        self.children = []
+        self.item = None
+        self.items = []
+        if struct is None:
+            self.kind = NODE_ANY
+        elif type(struct) is type:
+            self.kind = NODE_TYPE
+            self.type_name = struct.__name__
+        elif isinstance(struct, CustomType):
+            self.kind = NODE_CUSTOM
+            self.type_name = struct.mongo_type.__name__
+        elif isinstance(struct, SchemaOperator):
+            self.kind = NODE_OPERATOR
+        elif isinstance(struct, dict):
+            self.kind = NODE_DICT
+            self.dict_type = type(struct)
+            self.type_name = self.dict_type.__name__
+            self.length = len(struct) if '_id' not in struct else len(struct) - 1
+            self.keys = frozenset(struct)
+            for key, value in struct.iteritems():
+                if type(key) is type:
+                    # only embed dicts are processed under a type key ({unicode: {...}})
+                    new_path = ".".join([path, "$%s" % key.__name__]).strip('.')
+                    child_convert = convert and isinstance(value, dict) and not isinstance(value, CustomType)
+                    self.children.append((key, True, SchemaNode(value, new_path, child_convert)))
+                else:
+                    new_path = ".".join([path, key]).strip('.')
+                    self.children.append((key, False, SchemaNode(value, new_path, convert)))
+        elif isinstance(struct, list):
+            self.kind = NODE_LIST
+            item = struct[0] if len(struct) else None
+            item_convert = convert and type(struct) is list and isinstance(item, (CustomType, dict))
+            self.item = SchemaNode(item, path, item_convert)
+        elif isinstance(struct, tuple):
+            self.kind = NODE_TUPLE
+            self.items = [SchemaNode(i, path, False) for i in struct]
+        else:
+            # embed Document classes and other objects are not checked
+            self.kind = NODE_IGNORED
+
+
+class SchemaPlan(object):
+    """
+    The validation plan of a structure, compiled at class creation.
+
+    `index` maps each dotted path of the structure (ie 'foo.bar' or
+    'foo.$unicode') to its structure value. `has_custom_types` is False
+    if no value of a document needs to be converted by a CustomType,
+    `custom_type_fields` and `dict_fields` are the top level fields which
+    hold such values and the embed dicts.
+    """
+    def __init__(self, structure):
+        self.structure = structure
+        self.generation = _structure_generation[0]
+        self.root = SchemaNode(structure)
+        self.index = {}
+        self._build_index(self.root)
+        # top level fields which hold values converted by a CustomType
+        self.custom_type_fields = frozenset(
+            key for key, _, child in self.root.children if self._has_custom_types(child))
+        self.has_custom_types = bool(self.custom_type_fields)
+        self.dict_fields = frozenset(
+            key for key, is_type, child in self.root.children if not is_type and child.kind == NODE_DICT)
+
+    def _build_index(self, node):
+        for _, _, child in node.children:
+            self.index[child.path] = child.struct
+            if child.kind == NODE_DICT:
+                self._build_index(child)
+
+    def _has_custom_types(self, node):
+        # tell if _process_custom_type() would convert anything
+        if node.kind == NODE_CUSTOM:
+            return node.convert
+        if node.kind == NODE_DICT:
+            return any(self._has_custom_types(child) for _, _, child in node.children)
+        if node.kind == NODE_LIST:
+            return self._has_custom_types(node.item)
+        return False
+
+    def is_stale(self, structure):
+        return self.structure is not structure or self.generation != _structure_generation[0]
+
+
 class SchemaProperties(type):
     def __new__(mcs, name, bases, attrs):
         attrs['_protected_field_names'] = set(
@@ -214,6 +332,8 @@ class SchemaProperties(type):
         attrs['_i18n_namespace'] = []
         if attrs.get('i18n'):
             attrs['_i18n_namespace'] = set(['.'.join(i.split('.')[:-1]) for i in attrs['i18n']])
+        if isinstance(attrs.get('structure'), dict):
+            attrs['_validation_plan'] = SchemaPlan(attrs['structure'])
         return type.__new__(mcs, name, bases, attrs)
 
     @classmethod
@@ -323,6 +443,9 @@ class SchemaDocument(dict):
 
     skip_validation = False
 
+    # the compiled structure (see SchemaPlan), filled by SchemaProperties
+    _validation_plan = None
+
     # if you want to have all schemaless benefits (default False but should change)
     # warning, if use_schemaless is True, Migration features can not be used.
     use_schemaless = False
@@ -397,13 +520,12 @@ class SchemaDocument(dict):
         validators.
 
         """
+        plan = self._get_validation_plan()
         if self.validators:
-            self._process_validators(self, self.structure)
-        self._process_custom_type('bson', self, self.structure)
-        self._validate_doc(self, self.structure)
-        self._process_custom_type('python', self, self.structure)
+            self._process_validators(self, plan)
+        self._validate_doc(self, plan.root)
         if self.required_fields:
-            self._validate_required(self, self.structure)
+            self._validate_required(self, plan)
 
     def __setattr__(self, key, value):
         if key not in self._protected_field_names and self.use_dot_notation and key in self:
@@ -569,98 +691,113 @@ class SchemaDocument(dict):
                 self.validation_errors[field] = []
             self.validation_errors[field].append(exception(message))
 
-    def _validate_doc(self, doc, struct, path=""):
+    def _get_validation_plan(self):
+        """
+        return the compiled structure, rebuilding it only if the structure
+        has been modified since its compilation
+        """
+        plan = self._validation_plan
+        if plan is None or plan.is_stale(self.structure):
+            plan = SchemaPlan(self.structure)
+            if self.structure is self.__class__.structure:
+                self.__class__._validation_plan = plan
+        return plan
+
+    def _validate_doc(self, doc, node):
         """
-        check if doc field types match the doc field structure
+        check if doc field types match the compiled structure node
         """
-        if type(struct) is type or struct is None:
-            if struct is None:
-                if type(doc) not in self.authorized_types:
-                    self._raise_exception(AuthorizedTypeError, type(doc).__name__,
-                                          "%s is not an authorized types" % type(doc).__name__)
-            elif not isinstance(doc, struct) and doc is not None:
+        kind = node.kind
+        path = node.path
+        if kind == NODE_TYPE:
+            if not isinstance(doc, node.struct) and doc is not None:
                 self._raise_exception(SchemaTypeError, path,
                                       "%s must be an instance of %s not %s" % (
-                                          path, struct.__name__, type(doc).__name__))
-        elif isinstance(struct, CustomType):
+                                          path, node.type_name, type(doc).__name__))
+        elif kind == NODE_ANY:
+            if type(doc) not in self.authorized_types:
+                self._raise_exception(AuthorizedTypeError, type(doc).__name__,
+                                      "%s is not an authorized types" % type(doc).__name__)
+        elif kind == NODE_CUSTOM:
+            struct = node.struct
+            if node.convert:
+                # the value is checked under its bson form but the document
+                # is left untouched
+                if struct.python_type is not None:
+                    if not isinstance(doc, struct.python_type) and doc is not None:
+                        self._raise_exception(SchemaTypeError, path,
+                                              "%s must be an instance of %s not %s" % (
+                                                  path, struct.python_type.__name__, type(doc).__name__))
+                doc = struct.to_bson(doc)
             if not isinstance(doc, struct.mongo_type) and doc is not None:
                 self._raise_exception(SchemaTypeError, path,
                                       "%s must be an instance of %s not %s" % (
-                                          path, struct.mongo_type.__name__, type(doc).__name__))
+                                          path, node.type_name, type(doc).__name__))
             struct.validate(doc, path=path)
-        elif isinstance(struct, SchemaOperator):
-            if not struct.validate(doc) and doc is not None:
-                if isinstance(struct, IS):
+        elif kind == NODE_OPERATOR:
+            if not node.struct.validate(doc) and doc is not None:
+                if isinstance(node.struct, IS):
                     self._raise_exception(SchemaTypeError, path,
-                                          "%s must be in %s not %s" % (path, struct._operands, doc))
+                                          "%s must be in %s not %s" % (path, node.struct._operands, doc))
                 else:
                     self._raise_exception(SchemaTypeError, path,
-                                          "%s must be an instance of %s not %s" % (path, struct, type(doc).__name__))
-        elif isinstance(struct, dict):
-            if not isinstance(doc, type(struct)):
+                                          "%s must be an instance of %s not %s" % (
+                                              path, node.struct, type(doc).__name__))
+        elif kind == NODE_DICT:
+            if not isinstance(doc, node.dict_type):
                 self._raise_exception(SchemaTypeError, path,
                                       "%s must be an instance of %s not %s" % (
-                                          path, type(struct).__name__, type(doc).__name__))
-            struct_length = len(struct) if not '_id' in struct else len(struct) - 1
-            if len(doc) != struct_length:
-                struct_doc_diff = list(set(struct).difference(set(doc)))
+                                          path, node.type_name, type(doc).__name__))
+            if len(doc) != node.length:
+                struct_doc_diff = list(node.keys.difference(doc))
                 if struct_doc_diff:
                     for field in struct_doc_diff:
                         if (type(field) is not type) and (not self.use_schemaless):
                             self._raise_exception(StructureError, None,
                                                   "missed fields %s in %s" % (struct_doc_diff, type(doc).__name__))
                 else:
-                    struct_struct_diff = list(set(doc).difference(set(struct)))
-                    bad_fields = [s for s in struct_struct_diff if s not in STRUCTURE_KEYWORDS]
+                    bad_fields = [s for s in doc if s not in node.keys and s not in STRUCTURE_KEYWORDS]
                     if bad_fields and not self.use_schemaless:
                         self._raise_exception(StructureError, None,
                                               "unknown fields %s in %s" % (bad_fields, type(doc).__name__))
-            for key in struct:
-                if type(key) is type:
-                    new_key = "$%s" % key.__name__
-                else:
-                    new_key = key
-                new_path = ".".join([path, new_key]).strip('.')
-                if new_key.split('.')[-1].startswith("$"):
+            for key, is_type, child in node.children:
+                if is_type:
                     for doc_key in doc:
                         if not isinstance(doc_key, key):
                             self._raise_exception(SchemaTypeError, path,
                                                   "key of %s must be an instance of %s not %s" % (
                                                       path, key.__name__, type(doc_key).__name__))
-                        self._validate_doc(doc[doc_key], struct[key], new_path)
-                else:
-                    if key in doc:
-                        self._validate_doc(doc[key], struct[key],  new_path)
-        elif isinstance(struct, list):
+                        self._validate_doc(doc[doc_key], child)
+                elif key in doc:
+                    self._validate_doc(doc[key], child)
+        elif kind == NODE_LIST:
             if not isinstance(doc, list) and not isinstance(doc, tuple):
                 self._raise_exception(SchemaTypeError, path,
                                       "%s must be an instance of list not %s" % (path, type(doc).__name__))
-            if not len(struct):
-                struct = None
-            else:
-                struct = struct[0]
+            item = node.item
             for obj in doc:
-                self._validate_doc(obj, struct, path)
-        elif isinstance(struct, tuple):
+                self._validate_doc(obj, item)
+        elif kind == NODE_TUPLE:
             if not isinstance(doc, list) and not isinstance(doc, tuple):
                 self._raise_exception(SchemaTypeError, path,
                                       "%s must be an instance of list not %s" % (
                                           path, type(doc).__name__))
-            if len(doc) != len(struct):
+            if len(doc) != len(node.items):
                 self._raise_exception(SchemaTypeError, path, "%s must have %s items not %s" % (
-                    path, len(struct), len(doc)))
-            for i in range(len(struct)):
-                self._validate_doc(doc[i], struct[i], path)
+                    path, len(node.items), len(doc)))
+            for i, item in enumerate(node.items):
+                self._validate_doc(doc[i], item)
 
-    def _process_validators(self, doc, _struct, _path=""):
-        doted_doc = DotCollapsedDict(doc)
+    def _process_validators(self, doc, _plan):
         for key, validators in self.validators.iteritems():
-            if key in doted_doc and doted_doc[key] is not None:
+            value = get_dotted_value(doc, key)
+            # like DotCollapsedDict, only leaves are validated
+            if value is not None and not (isinstance(value, dict) and value):
                 if not hasattr(validators, "__iter__"):
                     validators = [validators]
                 for validator in validators:
                     try:
-                        if not validator(doted_doc[key]):
+                        if not validator(value):
                             raise ValidationError("%s does not pass the validator " + validator.__name__)
                     except Exception, e:
                         self._raise_exception(ValidationError, key,
@@ -809,18 +946,18 @@ class SchemaDocument(dict):
                     else:
                         doc[key] = new_value
 
-    def _validate_required(self, doc, _struct, _path="", _root_path=""):
-        doted_struct = DotCollapsedDict(self.structure)
-        doted_doc = DotCollapsedDict(doc, reference=doted_struct)
+    def _validate_required(self, doc, plan):
         for req in self.required_fields:
-            if doted_doc.get(req) is None and doted_struct.get(req) is not dict:
-                if not isinstance(doted_struct.get(req), CustomType):
+            value = get_dotted_value(doc, req)
+            struct = plan.index.get(req)
+            if value is None and struct is not dict:
+                if not isinstance(struct, CustomType):
                     self._raise_exception(RequireFieldError, req, "%s is required" % req)
-                elif isinstance(doted_struct.get(req), CustomType) and doted_struct[req].mongo_type is not dict:
+                elif isinstance(struct, CustomType) and struct.mongo_type is not dict:
                     self._raise_exception(RequireFieldError, req, "%s is required" % req)
-            elif doted_doc.get(req) == []:
+            elif value == []:
                 self._raise_exception(RequireFieldError, req, "%s is required" % req)
-            elif doted_doc.get(req) == {}:
+            elif value == {}:
                 self._raise_exception(RequireFieldError, req, "%s is required" % req)
 
     def __generate_skeleton(self, doc, struct, path=""):
@@ -900,6 +1037,7 @@ class SchemaDocument(dict):
                     field_type=doted_dict[field],
                     field_name=field
                 )
+                structure_changed()
         self.structure.update(DotExpandedDict(doted_dict))
 
     def set_lang(self, lang):
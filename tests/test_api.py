@@ -240,6 +240,11 @@ class ApiTestCase(unittest.TestCase):
         mydoc = self.col.MyDoc.find_and_modify(query={"baz": 1}, update={"$set": {"baz": 2}}, new=True)
         assert isinstance(mydoc, MyDoc)
         self.assertEquals(2, mydoc["baz"])
+        assert mydoc.collection.full_name == self.col.full_name
+        mydoc["baz"] = 3
+        mydoc.save()
+        assert self.col.find_one()["baz"] == 3
+        assert self.col.count() == 1
 
     def test_one(self):
         class MyDoc(Document):
@@ -262,6 +267,12 @@ class ApiTestCase(unittest.TestCase):
             mydoc.save()
         self.assertRaises(MultipleResultsFound, self.col.MyDoc.one)
         self.assertRaises(MultipleResultsFound, self.col.one)
+        try:
+            self.col.MyDoc.one({'foo':{'$lt':5}})
+        except MultipleResultsFound, e:
+            assert str(e) == 'more than one result found', str(e)
+        assert self.col.MyDoc.one({'foo':9})['foo'] == 9
+        assert self.col.MyDoc.one({'foo':42}) is None
 
     def test_find_random(self):
         class MyDoc(Document):
@@ -281,6 +292,326 @@ class ApiTestCase(unittest.TestCase):
         assert isinstance(mydoc, MyDoc)
         assert mydoc != raw_mydoc, (mydoc, raw_mydoc)
 
+    def test_sample(self):
+        class MyDoc(Document):
+            structure = {
+                "foo":int,
+                "random":float,
+            }
+            random_field = 'random'
+        self.connection.register([MyDoc])
+        assert self.col.MyDoc.sample(5) == []
+        for i in range(50):
+            mydoc = self.col.MyDoc()
+            mydoc["foo"] = i
+            mydoc.save()
+            assert 0 <= mydoc['random'] < 1
+        docs = self.col.MyDoc.sample(5)
+        assert len(docs) == 5
+        assert len(set(doc['_id'] for doc in docs)) == 5
+        assert all(isinstance(doc, MyDoc) for doc in docs)
+        assert len(self.col.MyDoc.sample(100)) == 50
+        # raw documents
+        docs = self.col.sample(5, random_field='random')
+        assert len(docs) == 5
+        assert not isinstance(docs[0], MyDoc)
+        assert len(self.col.sample(60, random_field='random')) == 50
+
+    def test_from_bson(self):
+        class CustomDate(CustomType):
+            mongo_type = unicode
+            python_type = int
+            def to_bson(self, value):
+                return unicode(value)
+            def to_python(self, value):
+                return int(value)
+        class MyDoc(Document):
+            use_dot_notation = True
+            structure = {
+                "foo":{"bar":int},
+                "date":CustomDate(),
+            }
+        self.connection.register([MyDoc])
+        mydoc = self.col.MyDoc()
+        mydoc.foo.bar = 3
+        mydoc['date'] = 42
+        mydoc.save()
+        raw_mydoc = self.col.find_one()
+        assert raw_mydoc['date'] == u'42'
+        mydoc = MyDoc.from_bson(raw_mydoc, collection=self.col)
+        assert isinstance(mydoc, MyDoc)
+        assert mydoc == self.col.MyDoc(raw_mydoc), (mydoc, self.col.MyDoc(raw_mydoc))
+        assert mydoc['date'] == 42
+        assert mydoc.foo.bar == 3
+        assert mydoc.collection is self.col
+        mydoc.foo.bar = 4
+        mydoc.save()
+        mydoc = self.col.MyDoc.find_one()
+        assert mydoc.foo.bar == 4
+        assert mydoc['date'] == 42
+        assert mydoc.validation_errors == {}
+
+    def test_lazy_cursor(self):
+        class CustomDate(CustomType):
+            mongo_type = unicode
+            python_type = int
+            def to_bson(self, value):
+                return unicode(value)
+            def to_python(self, value):
+                return int(value)
+        class MyDoc(Document):
+            use_dot_notation = True
+            structure = {
+                "foo":{"bar":int},
+                "date":CustomDate(),
+                "dates":[CustomDate()],
+            }
+        self.connection.register([MyDoc])
+        mydoc = self.col.MyDoc()
+        mydoc.foo.bar = 3
+        mydoc['date'] = 42
+        mydoc['dates'] = [1, 2]
+        mydoc.save()
+        mydoc = self.col.MyDoc.find().lazy().next()
+        assert isinstance(mydoc, MyDoc)
+        assert type(mydoc) is not MyDoc
+        assert dict.__getitem__(mydoc, 'date') == u'42'
+        assert mydoc['date'] == 42
+        assert mydoc.foo.bar == 3
+        assert type(mydoc) is not MyDoc
+        assert mydoc['dates'] == [1, 2]
+        assert type(mydoc) is MyDoc
+        # modifying the document loads all the fields
+        mydoc = self.col.MyDoc.find().lazy().next()
+        mydoc['date'] = 43
+        assert type(mydoc) is MyDoc
+        assert mydoc == {'_id': mydoc['_id'], 'foo': {'bar': 3}, 'date': 43, 'dates': [1, 2]}
+        mydoc.save()
+        mydoc = self.col.MyDoc.find().lazy().next()
+        mydoc.save()
+        assert self.col.find_one() == {'_id': mydoc['_id'], 'foo': {'bar': 3}, 'date': u'43',
+                                       'dates': [u'1', u'2']}
+
+    def test_partial_documents(self):
+        class MyDoc(Document):
+            structure = {
+                "foo":int,
+                "bar":{"baz":unicode, "qux":int},
+                "tags":[unicode],
+            }
+            required_fields = ['foo']
+        self.connection.register([MyDoc])
+        mydoc = self.col.MyDoc()
+        mydoc['foo'] = 1
+        mydoc['bar']['baz'] = u'a'
+        mydoc['bar']['qux'] = 2
+        mydoc['tags'] = [u'x', u'y', u'z']
+        mydoc.save()
+        mydoc = self.col.MyDoc.find_one(fields=['bar.baz'])
+        assert mydoc == {'_id': mydoc['_id'], 'bar': {'baz': u'a'}}
+        mydoc.validate()
+        mydoc['bar']['baz'] = u'b'
+        assert mydoc.get_changes() == {'$set': {'bar.baz': u'b'}}
+        mydoc.save()
+        assert self.col.find_one() == {'_id': mydoc['_id'], 'foo': 1, 'bar': {'baz': u'b', 'qux': 2},
+                                       'tags': [u'x', u'y', u'z']}
+        self.assertRaises(PartialDocumentError, mydoc.save, False, None, True, True)
+        assert self.col.MyDoc.save_many([mydoc]).keys() == [0]
+        # a sliced list can't be updated
+        mydoc = self.col.MyDoc.find_one(fields={'tags': {'$slice': 1}})
+        assert mydoc['tags'] == [u'x']
+        mydoc['tags'].append(u't')
+        self.assertRaises(PartialDocumentError, mydoc.save)
+        mydoc.reload()
+        assert mydoc['tags'] == [u'x', u'y', u'z']
+        mydoc['tags'].append(u't')
+        mydoc.save()
+        assert self.col.find_one()['tags'] == [u'x', u'y', u'z', u't']
+        # a removed partial document is not written back
+        mydoc = self.col.MyDoc.find_one(fields=['foo'])
+        self.col.remove()
+        mydoc['foo'] = 3
+        self.assertRaises(PartialDocumentError, mydoc.save)
+        assert self.col.count() == 0
+
+    def test_partial_documents_with_dot_notation(self):
+        class MyDoc(Document):
+            use_dot_notation = True
+            structure = {
+                "foo":int,
+                "bar":{"baz":unicode, "qux":{"quux":int}},
+            }
+        self.connection.register([MyDoc])
+        mydoc = self.col.MyDoc()
+        mydoc['foo'] = 1
+        mydoc.bar.baz = u'a'
+        mydoc.bar.qux.quux = 2
+        mydoc.save()
+        # the embedded documents left out by the projection are not added
+        mydoc = self.col.MyDoc.find_one(fields=['foo'])
+        assert mydoc == {'_id': mydoc['_id'], 'foo': 1}, mydoc
+        assert mydoc.get_changes() == {}
+        mydoc.foo = 3
+        mydoc.save()
+        assert self.col.find_one() == {'_id': mydoc['_id'], 'foo': 3,
+                                       'bar': {'baz': u'a', 'qux': {'quux': 2}}}
+        mydoc = self.col.MyDoc.find_one(fields=['bar.baz'])
+        assert mydoc == {'_id': mydoc['_id'], 'bar': {'baz': u'a'}}, mydoc
+        mydoc.bar.baz = u'b'
+        assert mydoc.get_changes() == {'$set': {'bar.baz': u'b'}}
+        mydoc.save()
+        assert self.col.find_one() == {'_id': mydoc['_id'], 'foo': 3,
+                                       'bar': {'baz': u'b', 'qux': {'quux': 2}}}
+        # a partially loaded embedded document can't be replaced
+        mydoc['bar'] = {}
+        self.assertRaises(PartialDocumentError, mydoc.save)
+
+    def test_values(self):
+        class CustomDate(CustomType):
+            mongo_type = unicode
+            python_type = int
+            def to_bson(self, value):
+                return unicode(value)
+            def to_python(self, value):
+                return int(value)
+        class MyDoc(Document):
+            structure = {
+                "foo":{"bar":int, "date":CustomDate()},
+                "items":[{"date":CustomDate()}],
+                "name":unicode,
+            }
+        self.connection.register([MyDoc])
+        for i in range(3):
+            mydoc = self.col.MyDoc()
+            mydoc['foo']['bar'] = i
+            mydoc['foo']['date'] = i * 10
+            mydoc['items'] = [{'date': i}, {'date': i + 1}]
+            mydoc['name'] = u'doc%s' % i
+            mydoc.save()
+        values = list(self.col.MyDoc.find().sort('foo.bar', 1).values('foo.bar', 'foo.date', 'items.date'))
+        assert values == [(0, 0, [0, 1]), (1, 10, [1, 2]), (2, 20, [2, 3])], values
+        assert list(self.col.MyDoc.find({'foo.bar': 1}).values('foo', 'name')) == [
+            ({'bar': 1, 'date': 10}, u'doc1')]
+        assert sorted(self.col.MyDoc.find().scalars('name')) == [u'doc0', u'doc1', u'doc2']
+        assert self.col.MyDoc.find().sort('foo.bar', -1).scalars('foo.date')[0] == 20
+        # raw documents are not converted
+        assert list(self.col.find({'foo.bar': 1}).values('foo.date', 'missing')) == [(u'10', None)]
+        # the custom types are applied through the nested lists
+        class NestedDoc(Document):
+            structure = {
+                "grid":[[CustomDate()]],
+                "groups":[{"items":[{"date":CustomDate()}]}],
+            }
+        self.connection.register([NestedDoc])
+        self.col.remove()
+        self.col.insert({'grid':[[u'1', u'2'], [u'3']],
+                         'groups':[{'items':[{'date':u'4'}, {'date':u'5'}]}, {'items':[{'date':u'6'}]}]})
+        assert list(self.col.NestedDoc.find().values('grid', 'groups.items.date')) == [
+            ([[1, 2], [3]], [[4, 5], [6]])]
+
+    def test_batches(self):
+        class MyDoc(Document):
+            structure = {
+                "foo":int,
+            }
+        self.connection.register([MyDoc])
+        for i in range(25):
+            mydoc = self.col.MyDoc()
+            mydoc['foo'] = i
+            mydoc.save()
+        batches = list(self.col.MyDoc.find().sort('foo', 1).batches(10))
+        assert [len(batch) for batch in batches] == [10, 10, 5]
+        assert all(isinstance(doc, MyDoc) for batch in batches for doc in batch)
+        assert [doc['foo'] for batch in batches for doc in batch] == range(25)
+        # the batches continue the iteration
+        cursor = self.col.MyDoc.find().sort('foo', 1).batch_size(10)
+        assert cursor.next()['foo'] == 0
+        assert [len(batch) for batch in cursor.batches()] == [9, 10, 5]
+        assert list(self.col.MyDoc.find({'foo': 100}).batches()) == []
+        assert list(self.col.find().sort('foo', 1).limit(3).batches()) == [list(self.col.find().sort('foo', 1).limit(3))]
+
+    def test_prefetch(self):
+        class MyDoc(Document):
+            structure = {
+                "foo":int,
+            }
+        self.connection.register([MyDoc])
+        for i in range(25):
+            mydoc = self.col.MyDoc()
+            mydoc['foo'] = i
+            mydoc.save()
+        cursor = self.col.MyDoc.find().sort('foo', 1).batch_size(10).prefetch(2)
+        docs = list(cursor)
+        assert [doc['foo'] for doc in docs] == range(25)
+        assert all(isinstance(doc, MyDoc) for doc in docs)
+        cursor.rewind()
+        assert cursor.next()['foo'] == 0
+        assert [len(batch) for batch in cursor.batches()] == [9, 10, 5]
+        cursor = self.col.MyDoc.find().sort('foo', 1).limit(15).prefetch()
+        assert [len(batch) for batch in cursor.batches(10)] == [10, 5]
+        cursor = self.col.MyDoc.find().batch_size(5).prefetch()
+        cursor.next()
+        cursor.close()
+        self.assertRaises(StopIteration, cursor.next)
+        assert list(self.col.MyDoc.find({'foo': 100}).prefetch()) == []
+
+    def test_parallel_find(self):
+        class MyDoc(Document):
+            structure = {
+                "foo":int,
+                "bar":int,
+            }
+        self.connection.register([MyDoc])
+        for i in range(100):
+            mydoc = self.col.MyDoc()
+            mydoc['foo'] = i
+            mydoc['bar'] = i % 3
+            mydoc.save()
+        self.col.ensure_index('foo')
+        docs = list(self.col.MyDoc.parallel_find(workers=4))
+        assert sorted(doc['foo'] for doc in docs) == range(100)
+        assert all(isinstance(doc, MyDoc) for doc in docs)
+        docs = list(self.col.MyDoc.parallel_find({'bar': 1}, workers=3, field='foo', ordered=True))
+        assert [doc['foo'] for doc in docs] == range(1, 100, 3)
+        docs = list(self.col.parallel_find({'bar': 1}, workers=3, field='foo', fields=['bar']))
+        assert sorted(doc['foo'] for doc in docs) == range(1, 100, 3)
+        assert list(self.col.MyDoc.parallel_find({'bar': 5})) == []
+        # the ranges are split on the documents matching the query
+        points = self.col._get_split_points({'foo': {'$gte': 80}}, 'foo', 4)
+        assert points and all(point >= 80 for point in points), points
+        docs = list(self.col.MyDoc.parallel_find({'foo': {'$gte': 80}}, workers=4, field='foo'))
+        assert sorted(doc['foo'] for doc in docs) == range(80, 100)
+
+    def test_parallel_find_resume(self):
+        from pymongo.errors import AutoReconnect
+        failures = []
+        class CustomNumber(CustomType):
+            mongo_type = unicode
+            python_type = int
+            def to_bson(self, value):
+                return unicode(value)
+            def to_python(self, value):
+                if value == u'99' and not failures:
+                    # the connection is lost while the second batch is read
+                    failures.append(value)
+                    raise AutoReconnect('connection lost')
+                return int(value)
+        class MyDoc(Document):
+            structure = {
+                "foo":CustomNumber(),
+            }
+        self.connection.register([MyDoc])
+        for i in range(250):
+            mydoc = self.col.MyDoc()
+            mydoc['foo'] = i
+            mydoc.save()
+        # the scan is resumed after the database value of the last document
+        docs = list(self.col.MyDoc.parallel_find(workers=1, field='foo'))
+        assert failures == [u'99']
+        assert sorted(doc['foo'] for doc in docs) == range(250)
+        # the other errors are not retried
+        self.assertRaises(OperationFailure, list, self.col.MyDoc.parallel_find({'foo': {'$bad': 1}}, workers=1))
+
     def test_fetch(self):
         class DocA(Document):
             structure = {
@@ -590,6 +921,119 @@ class ApiTestCase(unittest.TestCase):
 
         mydoc['doc']['bla'] = u'b'*40000000
         self.assertRaises(MaxDocumentSizeError, mydoc.validate)
+        self.assertRaises(MaxDocumentSizeError, mydoc.save)
+        self.assertRaises(MaxDocumentSizeError, mydoc.save, validate=False)
+        assert mydoc['doc']['bla'] == u'b'*40000000
+        assert self.col.MyDoc.find().count() == 0
+
+    def test_get_max_bson_size(self):
+        max_bson_size = self.connection.get_max_bson_size()
+        assert max_bson_size == self.connection.max_bson_size, max_bson_size
+        assert self.connection._max_bson_size == max_bson_size
+        assert self.connection.get_max_bson_size(refresh=True) == max_bson_size
+
+        class MyDoc(Document):
+            structure = {"foo":int}
+        self.connection.register([MyDoc])
+        mydoc = self.col.MyDoc()
+        assert mydoc._get_size_limit()[0] == max_bson_size
+
+    def test_save_many(self):
+        class MyDoc(Document):
+            structure = {"foo":int, "bar":unicode}
+            required_fields = ["foo"]
+        self.connection.register([MyDoc])
+
+        docs = []
+        for i in xrange(10):
+            mydoc = self.col.MyDoc()
+            mydoc['foo'] = i
+            docs.append(mydoc)
+        docs[3]['foo'] = None
+        docs.append({'foo':10, 'bar':u'raw'})
+        errors = self.col.MyDoc.save_many(docs, batch_size=3)
+        assert errors.keys() == [3], errors
+        assert isinstance(errors[3], RequireFieldError)
+        assert '_id' not in docs[3]
+        assert self.col.MyDoc.find().count() == 10
+        assert self.col.MyDoc.get_from_id(docs[10]['_id'])['bar'] == u'raw'
+
+        # documents with an _id are updated
+        docs[0]['bar'] = u'updated'
+        docs[3]['foo'] = 3
+        errors = self.col.MyDoc.save_many([docs[0], docs[3]])
+        assert errors == {}, errors
+        assert self.col.MyDoc.find().count() == 11
+        assert self.col.MyDoc.get_from_id(docs[0]['_id'])['bar'] == u'updated'
+
+        # the documents refused by the driver don't stop the others
+        docs = [{'foo':20, 'bar':None}, {'foo':21, 'bar':u'b'*(self.connection.get_max_bson_size() + 1)},
+                {'foo':22, 'bar':None}]
+        errors = self.col.MyDoc.save_many(docs)
+        assert errors.keys() == [1], errors
+        assert isinstance(errors[1], MaxDocumentSizeError)
+        assert self.col.MyDoc.find({'foo':{'$gte':20}}).count() == 2
+        errors = self.col.MyDoc.insert_many([{'foo':23, 'bar':None}, docs[1]])
+        assert errors.keys() == [1], errors
+        assert isinstance(errors[1], MaxDocumentSizeError)
+        assert self.col.MyDoc.find({'foo':{'$gte':20}}).count() == 3
+
+    def test_partial_updates(self):
+        class MyDoc(Document):
+            structure = {"foo":int, "bar":{"spam":unicode, "egg":[int]}, "baz":unicode}
+            use_partial_updates = True
+        self.connection.register([MyDoc])
+
+        mydoc = self.col.MyDoc()
+        mydoc['foo'] = 1
+        mydoc['bar']['egg'] = [1, 2]
+        mydoc.save()
+        mydoc['foo'] = 2
+        assert mydoc.get_changes() == {'$set':{'foo':2}}, mydoc.get_changes()
+
+        mydoc = self.col.MyDoc.find_one()
+        assert mydoc.get_changes() == {}
+        # fields modified by someone else are kept
+        self.col.update({'_id':mydoc['_id']}, {'$set':{'baz':u'other'}})
+        mydoc['foo'] = 3
+        mydoc['bar']['spam'] = u'spam'
+        mydoc['bar']['egg'].append(3)
+        assert mydoc.get_changes() == {'$set':{'foo':3, 'bar.spam':u'spam'},
+                                       '$push':{'bar.egg':{'$each':[3]}}}, mydoc.get_changes()
+        mydoc.save()
+        assert mydoc.get_changes() == {}
+        assert self.col.find_one() == {'_id':mydoc['_id'], 'foo':3, 'baz':u'other',
+                                       'bar':{'spam':u'spam', 'egg':[1, 2, 3]}}, self.col.find_one()
+
+        del mydoc['baz']
+        assert mydoc.get_changes() == {'$unset':{'baz':1}}
+        mydoc.save(validate=False)
+        assert 'baz' not in self.col.find_one()
+
+        # a removed document is saved again
+        self.col.remove()
+        mydoc['foo'] = 4
+        mydoc.save()
+        assert self.col.find_one()['foo'] == 4
+        assert self.col.find_one()['bar']['egg'] == [1, 2, 3]
+
+    def test_insert_many(self):
+        class MyDoc(Document):
+            structure = {"foo":int}
+        self.connection.register([MyDoc])
+
+        mydoc = self.col.MyDoc()
+        mydoc['_id'] = u'existing'
+        mydoc['foo'] = 0
+        mydoc.save()
+
+        docs = [{'_id':u'existing', 'foo':1}, {'foo':2}, {'foo':3}]
+        errors = self.col.MyDoc.insert_many(docs, uuid=True)
+        assert errors.keys() == [0], errors
+        assert isinstance(errors[0], DuplicateKeyError)
+        assert self.col.MyDoc.get_from_id(u'existing')['foo'] == 0
+        assert docs[1]['_id'].startswith('MyDoc-')
+        assert self.col.MyDoc.find().count() == 3
 
     def test_get_with_no_wrap(self):
         class MyDoc(Document):
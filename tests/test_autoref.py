@@ -979,3 +979,133 @@ class AutoRefTestCase(unittest.TestCase):
         event.validate()
         event.save()
 
+
+    def test_prefetch_autorefs(self):
+        class DocA(Document):
+            structure = {
+                "a":{'foo':int},
+            }
+
+        class DocB(Document):
+            structure = {
+                "b":{"doc_a":DocA, "docs_a":[DocA]},
+                "foo":int,
+            }
+            use_autorefs = True
+        self.connection.register([DocA, DocB])
+
+        docas = []
+        for i in range(5):
+            doca = self.connection.test.doca.DocA()
+            doca['a']['foo'] = i
+            doca.save()
+            docas.append(doca)
+        for i in range(5):
+            docb = self.col.DocB()
+            docb['b']['doc_a'] = docas[i]
+            docb['b']['docs_a'] = docas[:i]
+            docb['foo'] = i
+            docb.save()
+
+        cursor = self.col.DocB.find().sort('foo', 1).prefetch_autorefs()
+        first = cursor.next()
+        # the referenced documents of the batch are already fetched
+        self.connection.test.drop_collection('doca')
+        docbs = [first] + list(cursor)
+        assert len(docbs) == 5
+        for i, docb in enumerate(docbs):
+            assert isinstance(docb['b']['doc_a'], DocA)
+            assert docb['b']['doc_a'] == docas[i], docb
+            assert docb['b']['docs_a'] == docas[:i], docb
+        assert docbs[1]['b']['doc_a'] is not docbs[2]['b']['docs_a'][1]
+
+        self.assertRaises(AutoReferenceError, self.col.DocB.find().next)
+
+    def test_lazy_autorefs(self):
+        class DocA(Document):
+            structure = {
+                "a":{'foo':int},
+            }
+
+        class DocB(Document):
+            structure = {
+                "b":{"doc_a":DocA, "docs_a":[DocA]},
+            }
+            use_autorefs = True
+            lazy_autorefs = True
+        self.connection.register([DocA, DocB])
+
+        doca = self.col.DocA()
+        doca['_id'] = 'doca'
+        doca['a']['foo'] = 3
+        doca.save()
+        docb = self.col.DocB()
+        docb['_id'] = 'docb'
+        docb['b']['doc_a'] = doca
+        docb['b']['docs_a'] = [doca]
+        docb.save()
+
+        docb = self.col.DocB.get_from_id('docb')
+        ref = docb['b']['doc_a']
+        assert type(ref) is LazyAutoRef
+        assert isinstance(ref, DocA)
+        assert not ref.loaded
+        assert ref.dbref == DBRef(database='test', collection='mongokit', id='doca')
+        assert type(docb['b']['docs_a'][0]) is LazyAutoRef
+        # saving the document doesn't fetch the references
+        docb.save()
+        assert not ref.loaded
+        assert self.col.find_one({'_id':'docb'})['b']['doc_a'] == ref.dbref
+
+        docb = self.col.DocB.get_from_id('docb')
+        assert docb['b']['doc_a']['a']['foo'] == 3
+        assert docb['b']['doc_a'].loaded
+        assert docb['b']['doc_a'] == doca
+        assert docb['b']['docs_a'] == [doca]
+        # a fetched reference is saved if modified
+        docb['b']['doc_a']['a']['foo'] = 4
+        docb.save()
+        assert self.col.DocA.get_from_id('doca')['a']['foo'] == 4
+
+    def test_autoref_changes_tracking(self):
+        class DocA(Document):
+            structure = {
+                "a":{'foo':int},
+            }
+
+        class DocB(Document):
+            structure = {
+                "b":{"doc_a":DocA, "docs_a":[DocA]},
+            }
+            use_autorefs = True
+        self.connection.register([DocA, DocB])
+
+        docas = []
+        for i in range(4):
+            doca = self.col.DocA()
+            doca['_id'] = u'doca%s' % i
+            doca['a']['foo'] = i
+            doca.save()
+            docas.append(doca)
+        docb = self.col.DocB()
+        docb['b']['doc_a'] = docas[0]
+        docb['b']['docs_a'] = docas[1:]
+        docb.save()
+
+        docb = self.col.DocB.find_one()
+        # only a fingerprint of the embed docs is kept
+        assert not [i for i in docb._dbrefs.values() if isinstance(i, dict)], docb._dbrefs
+        docb['b']['doc_a']['a']['foo'] = 10
+        docb['b']['docs_a'][0]['a']['foo'] = 11
+        docb['b']['docs_a'][2]['a']['foo'] = 13
+        docb.save()
+        assert [self.col.DocA.get_from_id(u'doca%s' % i)['a']['foo'] for i in range(4)] == [10, 11, 2, 13]
+        # the values which have the same hash are told apart
+        docb['b']['docs_a'][1]['a']['foo'] = -1
+        docb.save()
+        docb['b']['docs_a'][1]['a']['foo'] = -2
+        docb.save()
+        assert self.col.DocA.get_from_id(u'doca2')['a']['foo'] == -2
+
+        docb['b']['docs_a'][1]['a'] = {}
+        self.assertRaises(StructureError, docb.save)
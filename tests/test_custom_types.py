@@ -105,6 +105,37 @@ class CustomTypesTestCase(unittest.TestCase):
         assert r_saved == {u'_id': u'bla', u'price': 9.9900000000000002}
 
 
+    def test_validate_does_not_convert_custom_types(self):
+        import datetime
+        class CustomDate(CustomType):
+            mongo_type = unicode
+            python_type = datetime.datetime
+            def to_bson(self, value):
+                """convert type to a mongodb type"""
+                return unicode(datetime.datetime.strftime(value,'%y-%m-%d'))
+            def to_python(self, value):
+                """convert type to a python object"""
+                if value is not None:
+                    return datetime.datetime.strptime(value, '%y-%m-%d')
+
+        class Foo(SchemaDocument):
+            structure = {
+                'date': CustomDate(),
+                'foo': {'dates': [CustomDate()]},
+            }
+        foo = Foo()
+        date = datetime.datetime(2003, 2, 1)
+        dates = [datetime.datetime(2008, 6, 7)]
+        foo['date'] = date
+        foo['foo']['dates'] = dates
+        foo.validate()
+        assert foo['date'] is date
+        assert foo['foo']['dates'] is dates
+        foo['foo']['dates'].append(3)
+        self.assertRaises(SchemaTypeError, foo.validate)
+        assert foo['date'] is date
+        assert foo['foo']['dates'] is dates
+
     def test_instance_type(self):
         from bson.dbref import DBRef
         from bson.objectid import ObjectId
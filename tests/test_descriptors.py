@@ -120,6 +120,19 @@ class DescriptorsTestCase(unittest.TestCase):
         mydoc = self.col.MyDoc()
         self.assertRaises(RequireFieldError, mydoc.validate )
 
+    def test_dict_required_filled(self):
+        class MyDoc(Document):
+            structure = {
+                "foo":{"bar":dict, "spam":int},
+            }
+            required_fields = ["foo", "foo.bar"]
+        self.connection.register([MyDoc])
+        mydoc = self.col.MyDoc()
+        mydoc['foo']['bar'] = {'egg': 3}
+        mydoc.validate()
+        mydoc['foo']['bar'] = {}
+        self.assertRaises(RequireFieldError, mydoc.validate)
+
     def test_default_values(self):
         class MyDoc(Document):
             structure = {
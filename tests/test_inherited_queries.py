@@ -28,6 +28,7 @@
 import unittest
 
 from mongokit import Document, Connection
+from pymongo.errors import InvalidOperation
 
 class InheritedQueriesTestCase(unittest.TestCase):
     def setUp(self):
@@ -227,3 +228,37 @@ class InheritedQueriesTestCase(unittest.TestCase):
         self.assertTrue(isinstance(self.col.A.find({'_id':doc_b['_id']}).next(), B))
 
 
+
+    def test_polymorphic(self):
+        @self.connection.register
+        class A(Document):
+            structure = {
+                '_type': unicode,
+                'a': int,
+            }
+
+        @self.connection.register
+        class B(A):
+            structure = {
+                'b': int,
+            }
+
+        @self.connection.register
+        class C(A):
+            structure = {
+                'c': int,
+            }
+
+        for doc in [self.col.A(), self.col.B(), self.col.C(), self.col.B()]:
+            doc.save()
+
+        docs = list(self.col.A.find().sort('_id', 1))
+        self.assertEqual([type(doc) for doc in docs], [A, B, C, B])
+        docs = list(self.col.A.find().sort('_id', 1).polymorphic(B))
+        self.assertEqual([type(doc) for doc in docs], [A, B, A, B])
+        docs = list(self.col.A.find().sort('_id', 1).polymorphic())
+        self.assertEqual([type(doc) for doc in docs], [A, A, A, A])
+        # the wrapping can't change once the iteration has started
+        cursor = self.col.A.find().sort('_id', 1)
+        cursor.next()
+        self.assertRaises(InvalidOperation, cursor.polymorphic, B)
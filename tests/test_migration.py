@@ -25,6 +25,7 @@
 # (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
 # SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
+import re
 import unittest
 
 from mongokit import *
@@ -151,6 +152,45 @@ class MigrationTestCase(unittest.TestCase):
         # migration should pass as we're unsetting from structure
         migration.migrate_all(self.col)
 
+    def test_chunked_all_migration(self):
+        class BlogPost(Document):
+            structure = {
+                "author":unicode,
+                "blog_post":{
+                    "title": unicode,
+                    "created_at": datetime,
+                    "body": unicode,
+                    "tags":  [unicode],
+                }
+            }
+        self.connection.register([BlogPost])
+        class BlogPostMigration(DocumentMigration):
+            def allmigration01_add_tags(self):
+                self.target = {'blog_post':{'$exists':True}, 'blog_post.tags':{'$exists':False}}
+                self.update = {'$set':{'blog_post.tags':[]}}
+        migration = BlogPostMigration(BlogPost)
+        progress = []
+        results = migration.migrate_all(self.col, batch_size=3, workers=2, checkpoint='migrations',
+                                        progress=lambda name, stats: progress.append(stats['matched']))
+        self.assertEqual(results['allmigration01_add_tags']['matched'], 10)
+        self.assertEqual(results['allmigration01_add_tags']['modified'], 10)
+        self.assertEqual(progress, [6, 10])
+        for bp in self.col.BlogPost.find():
+            bp.validate()
+        checkpoint = self.connection.test.migrations.find_one()
+        assert checkpoint['done'] is True
+        self.assertEqual(checkpoint['matched'], 10)
+        # a finished migration is not applied again
+        self.assertEqual(migration.migrate_all(self.col, batch_size=3, checkpoint='migrations'), {})
+
+        # resume after the last migrated document
+        self.col.update({}, {'$unset':{'blog_post.tags':1}}, multi=True)
+        last_id = sorted(self.col.find().distinct('_id'))[4]
+        self.connection.test.migrations.update({}, {'$set':{'done':False, 'last_id':last_id}})
+        results = migration.migrate_all(self.col, batch_size=3, checkpoint='migrations')
+        self.assertEqual(results['allmigration01_add_tags']['matched'], 15)
+        self.assertEqual(self.col.find({'blog_post.tags':{'$exists':True}}).count(), 5)
+
     def test_simple_all_migration_with_bad_update(self):
         class BlogPost(Document):
             structure = {
@@ -212,6 +252,186 @@ class MigrationTestCase(unittest.TestCase):
         bp.save()
         assert bp['blog_post']['title'] == 'Hello big World', bp['blog_post']
 
+    def test_lazy_migration_with_schema_version(self):
+        class BlogPostMigration(DocumentMigration):
+            def migration01__add_tags(self):
+                self.target = {'blog_post':{'$exists':True}, 'blog_post.tags':{'$exists':False}}
+                self.update = {'$set':{'blog_post.tags':[]}}
+        class BlogPost(Document):
+            structure = {
+                "author":unicode,
+                "blog_post":{
+                    "title": unicode,
+                    "created_at": datetime,
+                    "body": unicode,
+                    "tags": [unicode],
+                }
+            }
+            migration_handler = BlogPostMigration
+            use_schema_version = True
+        self.connection.register([BlogPost])
+        self.assertEqual(BlogPostMigration(BlogPost).get_version(), 1)
+
+        bp = self.col.BlogPost.find_one({'blog_post.title': u'hello 0'})
+        self.assertEqual(bp['blog_post']['tags'], [])
+        self.assertEqual(bp['_version'], 1)
+        self.assertEqual(self.col.find_one({'_id': bp['_id']})['_version'], 1)
+        bp.save()
+        self.assertEqual(self.col.find_one({'_id': bp['_id']})['_version'], 1)
+
+        # the stamped documents are not checked anymore
+        self.col.update({'blog_post.title': u'hello 1'}, {'$set': {'_version': 1}})
+        bp = self.col.BlogPost.find_one({'blog_post.title': u'hello 1'})
+        assert 'tags' not in bp['blog_post']
+
+        # the new documents are stamped when saved
+        bp = self.col.BlogPost()
+        bp['blog_post']['title'] = u'new'
+        bp.save()
+        self.assertEqual(self.col.find_one({'_id': bp['_id']})['_version'], 1)
+
+        # the outdated documents are checked again
+        class BlogPostMigration(BlogPostMigration):
+            version = 2
+            def migration02__add_views(self):
+                self.target = {'views':{'$exists':False}}
+                self.update = {'$set':{'views':0}}
+        class BlogPost(BlogPost):
+            structure = {'views': int}
+            migration_handler = BlogPostMigration
+        self.connection.register([BlogPost])
+        bp = self.col.BlogPost.find_one({'blog_post.title': u'new'})
+        self.assertEqual(bp['views'], 0)
+        self.assertEqual(bp['_version'], 2)
+
+    def test_lazy_migration_with_projection(self):
+        class BlogPostMigration(DocumentMigration):
+            def migration01__add_tags(self):
+                self.target = {'blog_post':{'$exists':True}, 'blog_post.tags':{'$exists':False}}
+                self.update = {'$set':{'blog_post.tags':[]}}
+        class BlogPost(Document):
+            structure = {
+                "author":unicode,
+                "blog_post":{
+                    "title": unicode,
+                    "created_at": datetime,
+                    "body": unicode,
+                    "tags": [unicode],
+                }
+            }
+            migration_handler = BlogPostMigration
+        class CustomBlogPost(BlogPost):
+            def __init__(self, *args, **kwargs):
+                super(CustomBlogPost, self).__init__(*args, **kwargs)
+        self.connection.register([BlogPost, CustomBlogPost])
+
+        # the partial documents are neither validated nor migrated on read
+        for name in ['BlogPost', 'CustomBlogPost']:
+            bp = getattr(self.col, name).find_one({'blog_post.title': u'hello 0'}, fields=['author'])
+            self.assertEqual(bp, {'_id': bp['_id'], 'author': None})
+            assert 'tags' not in self.col.find_one({'_id': bp['_id']})['blog_post']
+        # the complete documents still are
+        bp = self.col.CustomBlogPost.find_one({'blog_post.title': u'hello 0'})
+        self.assertEqual(bp['blog_post']['tags'], [])
+        self.assertEqual(self.col.find_one({'_id': bp['_id']})['blog_post']['tags'], [])
+
+    def test_deferred_lazy_migration(self):
+        class BlogPostMigration(DocumentMigration):
+            def migration01__add_tags(self):
+                self.target = {'blog_post':{'$exists':True}, 'blog_post.tags':{'$exists':False}}
+                self.update = {'$set':{'blog_post.tags':[]}}
+            def migration02__rename_create_at_to_creation_date(self):
+                if 'created_at' in self.doc['blog_post']:
+                    self.target = {'blog_post.created_at':{'$exists':True}}
+                    self.update = {
+                      '$set':{'blog_post.creation_date': self.doc['blog_post']['created_at']},
+                      '$unset':{'blog_post.created_at':1}
+                    }
+        class BlogPost(Document):
+            structure = {
+                "author":unicode,
+                "blog_post":{
+                    "title": unicode,
+                    "creation_date": datetime,
+                    "body": unicode,
+                    "tags": [unicode],
+                }
+            }
+            migration_handler = BlogPostMigration
+            use_deferred_migrations = True
+        self.connection.register([BlogPost])
+
+        migration = BlogPostMigration(BlogPost)
+        raw_doc = self.col.find_one()
+        upgraded, updates = migration.upgrade(raw_doc)
+        self.assertEqual(upgraded['blog_post']['tags'], [])
+        self.assertEqual(upgraded['blog_post']['creation_date'], datetime(2010, 1, 1))
+        self.assertEqual(len(updates), 2)
+        assert 'tags' not in raw_doc['blog_post']
+
+        cursor = self.col.BlogPost.find().batch_size(4)
+        for bp in cursor:
+            assert 'created_at' not in bp['blog_post']
+            self.assertEqual(bp['blog_post']['creation_date'], datetime(2010, 1, 1))
+            self.assertEqual(bp['blog_post']['tags'], [])
+        # the updates are sent at the end of each batch
+        self.assertEqual(self.col.find({'blog_post.creation_date':{'$exists':True},
+                                        'blog_post.tags':[]}).count(), 10)
+        self.assertEqual(self.col.find({'blog_post.created_at':{'$exists':True}}).count(), 0)
+
+        # the migrations which can't be run in memory update the database directly
+        class BlogPostMigration(BlogPostMigration):
+            def migration03__add_views(self):
+                self.target = {'$where': 'this.views == undefined'}
+                self.update = {'$set':{'views':0}}
+        class BlogPost(BlogPost):
+            structure = {'views': int}
+            migration_handler = BlogPostMigration
+        self.connection.register([BlogPost])
+        bp = self.col.BlogPost.find_one()
+        self.assertEqual(bp['views'], 0)
+        self.assertEqual(self.col.find_one({'_id': bp['_id']})['views'], 0)
+
+    def test_deferred_lazy_migration_fallback(self):
+        class RegexMigration(DocumentMigration):
+            def migration01__add_tags(self):
+                self.target = {'blog_post.title':re.compile('^hello')}
+                self.update = {'$set':{'blog_post.tags':[]}}
+        class InMigration(DocumentMigration):
+            def migration01__add_tags(self):
+                self.target = {'blog_post.title':{'$in':[re.compile('^hello'), u'bye']}}
+                self.update = {'$set':{'blog_post.tags':[]}}
+        class ReplaceMigration(DocumentMigration):
+            def migration01__replace(self):
+                self.target = {'blog_post':{'$exists':True}}
+                self.update = {'author':u'namlook', 'blog_post':{'title':u'replaced'}}
+        raw_doc = self.col.find_one()
+        # the regular expressions and the replacements are left to the server
+        for migration_class in (RegexMigration, InMigration, ReplaceMigration):
+            self.assertEqual(migration_class(None).upgrade(raw_doc), None)
+
+        class BlogPost(Document):
+            structure = {
+                "author":unicode,
+                "blog_post":{
+                    "title": unicode,
+                    "created_at": datetime,
+                    "body": unicode,
+                    "tags": [unicode],
+                }
+            }
+            migration_handler = RegexMigration
+            use_deferred_migrations = True
+            use_schema_version = True
+        self.connection.register([BlogPost])
+        bp = self.col.BlogPost.find_one({'_id': raw_doc['_id']})
+        self.assertEqual(bp['blog_post']['tags'], [])
+        self.assertEqual(bp['_version'], 1)
+        self.col.flush_migrations()
+        raw_doc = self.col.find_one({'_id': raw_doc['_id']})
+        self.assertEqual(raw_doc['blog_post']['tags'], [])
+        self.assertEqual(raw_doc['_version'], 1)
+
     def test_lazy_migration_with_skip_validation(self):
         # creating blog post migration
         class BlogPostMigration(DocumentMigration):
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+# Copyright (c) 2009-2011, Nicolas Clairon
+# All rights reserved.
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are met:
+#
+#     * Redistributions of source code must retain the above copyright
+#       notice, this list of conditions and the following disclaimer.
+#     * Redistributions in binary form must reproduce the above copyright
+#       notice, this list of conditions and the following disclaimer in the
+#       documentation and/or other materials provided with the distribution.
+#     * Neither the name of the University of California, Berkeley nor the
+#       names of its contributors may be used to endorse or promote products
+#       derived from this software without specific prior written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE REGENTS AND CONTRIBUTORS ``AS IS'' AND ANY
+# EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT LIMITED TO, THE IMPLIED
+# WARRANTIES OF MERCHANTABILITY AND FITNESS FOR A PARTICULAR PURPOSE ARE
+# DISCLAIMED. IN NO EVENT SHALL THE REGENTS AND CONTRIBUTORS BE LIABLE FOR ANY
+# DIRECT, INDIRECT, INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES
+# (INCLUDING, BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER CAUSED AND
+# ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT LIABILITY, OR TORT
+# (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN ANY WAY OUT OF THE USE OF THIS
+# SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
+
+import re
+import time
+import unittest
+from base64 import urlsafe_b64encode
+
+from bson import BSON
+from mongokit import Document, Connection
+from mongokit.paginator import CountCache, KeysetPaginator, Paginator
+
+
+class PaginatorTestCase(unittest.TestCase):
+    def setUp(self):
+        self.connection = Connection(safe=True)
+        self.col = self.connection['test']['mongokit']
+
+        class Item(Document):
+            structure = {
+                'name': unicode,
+                'rank': int,
+            }
+        self.connection.register([Item])
+        for i in range(25):
+            self.col.insert({'_id': i, 'name': u'item%s' % i, 'rank': i // 3})
+
+    def tearDown(self):
+        self.connection.drop_database('test')
+
+    def test_paginator_without_count(self):
+        paginator = Paginator(self.col.Item.find(), 1, 10, count=False)
+        self.assertEqual([item['_id'] for item in paginator.items], range(10))
+        assert paginator.has_next
+        assert not paginator.has_previous
+        assert paginator.is_paginated
+        assert paginator.count is None
+        assert paginator.num_pages is None
+        self.assertEqual(paginator.page_range, [1, 2])
+        self.assertEqual((paginator.start_index, paginator.end_index), (1, 10))
+
+        paginator = Paginator(self.col.Item.find(), 3, 10, count=False)
+        self.assertEqual([item['_id'] for item in paginator.items], range(20, 25))
+        assert not paginator.has_next
+        assert paginator.has_previous
+        assert paginator.num_pages is None
+        self.assertEqual(paginator.page_range, [1, 2, 3])
+        self.assertEqual((paginator.start_index, paginator.end_index), (21, 25))
+
+        # a page past the end is empty
+        paginator = Paginator(self.col.Item.find(), 4, 10, count=False)
+        self.assertEqual(paginator.items, [])
+        assert not paginator.has_next
+        assert paginator.has_previous
+        self.assertEqual((paginator.start_index, paginator.end_index), (0, 0))
+
+        paginator = Paginator(self.col.Item.find(), 2, 10, count='estimated')
+        self.assertEqual(paginator.count, 25)
+        self.assertEqual(paginator.num_pages, 3)
+        paginator = Paginator(self.col.Item.find({'rank': {'$lt': 2}}), 1, 10, count='estimated')
+        self.assertEqual(paginator.count, 6)
+        self.assertRaises(ValueError, Paginator, self.col.Item.find(), 1, 10, count='yes')
+
+    def test_paginator_with_count_cache(self):
+        count_cache = CountCache()
+        paginator = Paginator(self.col.Item.find({'rank': {'$lt': 4}}), 1, 10, count_cache=count_cache)
+        self.assertEqual(paginator.count, 12)
+        self.col.remove({'_id': 0})
+        # the count of the same query is taken from the cache
+        paginator = Paginator(self.col.Item.find({'rank': {'$lt': 4}}), 2, 10, count_cache=count_cache)
+        self.assertEqual(paginator.count, 12)
+        paginator = Paginator(self.col.Item.find({'rank': {'$lt': 3}}), 1, 10, count_cache=count_cache)
+        self.assertEqual(paginator.count, 8)
+
+    def _walk(self, limit, **kwargs):
+        pages = []
+        paginator = KeysetPaginator(self.col.Item.find(), limit, **kwargs)
+        pages.append([item['_id'] for item in paginator.items])
+        while paginator.has_next:
+            paginator = KeysetPaginator(self.col.Item.find(), limit, after=paginator.next_token, **kwargs)
+            pages.append([item['_id'] for item in paginator.items])
+        backward = []
+        while paginator.has_previous:
+            paginator = KeysetPaginator(self.col.Item.find(), limit, before=paginator.previous_token, **kwargs)
+            backward.append([item['_id'] for item in paginator.items])
+        return pages, backward, paginator
+
+    def test_keyset_paginator(self):
+        paginator = KeysetPaginator(self.col.Item.find(), 10)
+        assert isinstance(paginator.items[0], self.col.Item._obj_class)
+        assert paginator.has_next
+        assert not paginator.has_previous
+        assert paginator.previous_token is None
+
+        pages, backward, paginator = self._walk(10)
+        self.assertEqual(pages, [range(0, 10), range(10, 20), range(20, 25)])
+        self.assertEqual(backward, pages[-2::-1])
+        assert paginator.has_next
+        assert not paginator.has_previous
+
+        # the query of the cursor is kept
+        paginator = KeysetPaginator(self.col.Item.find({'rank': {'$lt': 4}}), 5)
+        paginator = KeysetPaginator(self.col.Item.find({'rank': {'$lt': 4}}), 5, after=paginator.next_token)
+        self.assertEqual([item['_id'] for item in paginator.items], range(5, 10))
+        assert paginator.has_next
+        paginator = KeysetPaginator(self.col.Item.find({'rank': {'$lt': 4}}), 5, after=paginator.next_token)
+        self.assertEqual([item['_id'] for item in paginator.items], [10, 11])
+        assert not paginator.has_next
+        assert paginator.next_token is None
+
+    def test_keyset_paginator_descending(self):
+        pages, backward, _ = self._walk(10, direction=-1)
+        self.assertEqual(pages, [range(24, 14, -1), range(14, 4, -1), range(4, -1, -1)])
+        self.assertEqual(backward, pages[-2::-1])
+
+    def test_keyset_paginator_with_ties(self):
+        # a page ends in the middle of the items of the same rank
+        pages, backward, _ = self._walk(4, key='rank')
+        self.assertEqual(sum(pages, []), range(25))
+        self.assertEqual(pages[1], [4, 5, 6, 7])
+        self.assertEqual(backward, pages[-2::-1])
+        pages, _, _ = self._walk(4, key='rank', direction=-1)
+        self.assertEqual(sum(pages, []), [24] + [i for r in range(7, -1, -1) for i in range(3 * r, 3 * r + 3)[::-1]])
+
+    def test_keyset_paginator_bad_token(self):
+        for token in ('not a token', 'Zm9v', '', u'\xe9'):
+            self.assertRaises(ValueError, KeysetPaginator, self.col.Item.find(), 10, after=token)
+        # the forged tokens can't inject operators in the query
+        for value in ({'i': {'$ne': None}}, {'i': 3, 'v': {'$ne': None}}, {'i': 3, 'v': re.compile('.*')},
+                      {'i': [1, 2], 'v': 1}):
+            token = urlsafe_b64encode(BSON.encode(value))
+            self.assertRaises(ValueError, KeysetPaginator, self.col.Item.find(), 10, after=token)
+            self.assertRaises(ValueError, KeysetPaginator, self.col.Item.find(), 10, before=token,
+                              key='rank')
+        self.assertRaises(ValueError, KeysetPaginator, self.col.Item.find(), 10, after='a', before='b')
+        self.assertRaises(ValueError, KeysetPaginator, self.col.Item.find(), 10, direction=2)
+
+
+class CountCacheTestCase(unittest.TestCase):
+    def test_ttl(self):
+        count_cache = CountCache(ttl=0.1)
+        count_cache.set('a', 3)
+        self.assertEqual(count_cache.get('a'), 3)
+        self.assertEqual(count_cache.get('b'), None)
+        time.sleep(0.15)
+        self.assertEqual(count_cache.get('a'), None)
+        self.assertEqual(count_cache._values, {})
+
+    def test_max_size(self):
+        count_cache = CountCache(max_size=2)
+        count_cache.set('a', 1)
+        time.sleep(0.01)
+        count_cache.set('b', 2)
+        # the oldest count is evicted
+        count_cache.set('c', 3)
+        self.assertEqual(sorted(count_cache._values), ['b', 'c'])
+        self.assertEqual(count_cache.get('a'), None)
+        # updating a cached count doesn't evict another one
+        count_cache.set('c', 4)
+        self.assertEqual((count_cache.get('b'), count_cache.get('c')), (2, 4))
+
+        # the expired counts are evicted first
+        count_cache = CountCache(ttl=0.1, max_size=2)
+        count_cache.set('a', 1)
+        time.sleep(0.15)
+        count_cache._ttl = 10
+        count_cache.set('b', 2)
+        count_cache.set('c', 3)
+        self.assertEqual(sorted(count_cache._values), ['b', 'c'])
@@ -328,3 +328,38 @@ class StructureTestCase(unittest.TestCase):
             failed = True
         self.assertEqual(failed, True)
 
+
+    def test_validation_plan_compiled_at_class_creation(self):
+        class MyDoc(SchemaDocument):
+            structure = {
+                'foo': int,
+                'bar': {'spam': [unicode], 'egg': {unicode: int}},
+            }
+        plan = MyDoc._validation_plan
+        assert plan is not None
+        assert plan.structure is MyDoc.structure
+        mydoc = MyDoc()
+        mydoc['foo'] = 3
+        mydoc['bar']['spam'] = [u'egg']
+        mydoc.validate()
+        assert MyDoc._validation_plan is plan
+        mydoc['bar']['spam'] = [3]
+        self.assertRaises(SchemaTypeError, mydoc.validate)
+
+    def test_validation_plan_rebuilt_after_i18n(self):
+        class MyDoc(SchemaDocument):
+            structure = {
+                'title': unicode,
+            }
+            i18n = ['title']
+        plan = MyDoc._validation_plan
+        # the first instance wraps the i18n fields of the structure
+        MyDoc()
+        assert MyDoc._validation_plan.is_stale(MyDoc.structure)
+        mydoc = MyDoc()
+        mydoc['title']['en'] = u'Hello'
+        mydoc['title']['fr'] = u'Salut'
+        mydoc.validate()
+        assert MyDoc._validation_plan is not plan
+        mydoc['title']['en'] = 3
+        self.assertRaises(SchemaTypeError, mydoc.validate)